@@ -0,0 +1,40 @@
+"""Merge time and peak memory of assemble_cube against the repeated xr.merge accumulation it replaces.
+
+    python benchmarks/bench_assembly.py --months 12 --providers 4 --size 128
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]/"tests"))
+
+from earthnet_minicuber.minicuber import assemble_cube
+from test_assembly import products, merge_cube
+
+
+def measure(f, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    f(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--months", type = int, default = 12)
+    parser.add_argument("--providers", type = int, default = 4)
+    parser.add_argument("--size", type = int, default = 128)
+    parser.add_argument("--steps", type = int, default = 8)
+    args = parser.parse_args()
+
+    pieces = products(n_months = args.months, n_providers = args.providers, size = args.size, steps = args.steps)
+    print(f"{len(pieces)} product cubes, {sum(p.nbytes for p in pieces) / 2**20:.0f} MB")
+
+    for name, f, f_args in [("xr.merge", merge_cube, (pieces, args.providers)), ("assemble_cube", assemble_cube, (pieces,))]:
+        elapsed, peak = measure(f, *f_args)
+        print(f"{name:>14}: {elapsed:7.2f} s, peak {peak:8.1f} MB allocated")
@@ -0,0 +1,59 @@
+"""Throughput per core, peak memory and agreement with a single untiled eager batch of the cloud mask for different batch sizes, tile sizes and engines.
+
+Each configuration runs in a fresh process, so peak memory is not inflated by earlier runs. Without --checkpoint-path, randomly initialized weights are used, which gives the same speed but a less meaningful agreement.
+
+    python benchmarks/bench_cloudmask.py --steps 16 --size 512 --threads 4 --checkpoint-path ~/weights
+"""
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[1]/"tests"))
+
+from earthnet_minicuber.minicuber import peak_memory_mb
+from earthnet_minicuber.provider.s2.cloudmask import CloudMask
+from test_cloudmask import random_checkpoint, scenes
+
+
+def run(args, config):
+    cloud_mask = CloudMask(checkpoint_path = args.checkpoint_path, num_threads = args.threads, **config)
+    x = scenes(steps = args.steps, size = args.size)
+    cloud_mask.predict(x[:1])
+    start = time.perf_counter()
+    mask = cloud_mask.predict(x)
+    elapsed = time.perf_counter() - start
+    return mask, elapsed, peak_memory_mb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type = int, default = 16)
+    parser.add_argument("--size", type = int, default = 512)
+    parser.add_argument("--threads", type = int, default = 4)
+    parser.add_argument("--checkpoint-path", default = None)
+    args = parser.parse_args()
+
+    if args.checkpoint_path is None:
+        args.checkpoint_path = random_checkpoint(Path(tempfile.mkdtemp()))
+
+    configs = {
+        "torch, one batch": dict(batch_size = None, tile_size = None),
+        "torch": dict(batch_size = 4, tile_size = 256, tile_overlap = 32),
+        "torch, no tiles": dict(batch_size = 4, tile_size = None),
+        "torchscript": dict(batch_size = 4, tile_size = 256, tile_overlap = 32, engine = "torchscript"),
+        "onnx": dict(batch_size = 4, tile_size = 256, tile_overlap = 32, engine = "onnx"),
+        "onnx int8": dict(batch_size = 4, tile_size = 256, tile_overlap = 32, engine = "onnx", quantize = True),
+    }
+
+    reference = None
+    for name, config in configs.items():
+        with ProcessPoolExecutor(1) as executor:
+            mask, elapsed, peak = executor.submit(run, args, config).result()
+        reference = mask if reference is None else reference
+        throughput = args.steps * args.size**2 / 1e6 / elapsed / args.threads
+        print(f"{name:>16}: {throughput:6.3f} Mpx/s per core, peak {peak:7.0f} MB, agreement {(mask == reference).mean():.4f}")
@@ -0,0 +1,55 @@
+"""Write time, read time and size of the NetCDF and Zarr minicube writers on a synthetic cube.
+
+    python benchmarks/bench_output.py --steps 146 --size 128 --bands 12 --threads 4
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import xarray as xr
+
+sys.path.insert(0, str(Path(__file__).parents[1]/"tests"))
+
+from earthnet_minicuber.minicuber import Minicuber
+from test_output import minicube
+
+
+def size_mb(path):
+    path = Path(path)
+    files = [path] if path.is_file() else [f for f in path.rglob("*") if f.is_file()]
+    return sum(f.stat().st_size for f in files) / 2**20
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type = int, default = 146)
+    parser.add_argument("--size", type = int, default = 128)
+    parser.add_argument("--bands", type = int, default = 12)
+    parser.add_argument("--threads", type = int, default = 4)
+    args = parser.parse_args()
+
+    cube = minicube(steps = args.steps, size = args.size, bands = args.bands)
+    print(f"cube of {cube.nbytes / 2**20:.0f} MB")
+
+    tmpdir = Path(tempfile.mkdtemp())
+    writers = [
+        ("netcdf zlib 9", "cube.nc", lambda path: Minicuber.save_minicube_netcdf(cube, path), xr.open_dataset),
+        ("zarr zstd", "zstd.zarr", lambda path: Minicuber.save_minicube_zarr(cube, path, compressor = "zstd", n_threads = args.threads), xr.open_zarr),
+        ("zarr lz4", "lz4.zarr", lambda path: Minicuber.save_minicube_zarr(cube, path, compressor = "lz4", n_threads = args.threads), xr.open_zarr),
+    ]
+    try:
+        for name, filename, write, open_ in writers:
+            path = tmpdir/filename
+            start = time.perf_counter()
+            write(path)
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with open_(path) as ds:
+                ds.load()
+            read_time = time.perf_counter() - start
+            print(f"{name:>14}: write {write_time:6.2f} s, read {read_time:6.2f} s, {size_mb(path):7.1f} MB")
+    finally:
+        shutil.rmtree(tmpdir)
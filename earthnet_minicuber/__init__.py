@@ -5,12 +5,14 @@ __author__ = "Vitus Benson"
 
 
 
-from . import provider, minicuber, plot
+from . import provider, minicuber, plot, runner
 
 from earthnet_minicuber.minicuber import Minicuber
 from earthnet_minicuber.provider.provider_base import Provider
 from earthnet_minicuber.provider import PROVIDERS
+from earthnet_minicuber.provider.item_cache import set_item_cache
 from earthnet_minicuber.plot import plot_rgb
+from earthnet_minicuber.runner import MinicubeRunner
 
 
 load_minicube = Minicuber.load_minicube
\ No newline at end of file
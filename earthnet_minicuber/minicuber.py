@@ -3,22 +3,43 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
+import dask
+import zarr
+import numcodecs
 
 from pyproj import Transformer
 from pyproj.aoi import AreaOfInterest
 from pyproj.database import query_utm_crs_info
 
 from pathlib import Path
+import os
+import shutil
 
 import pystac_client
 import rasterio
 import datetime
+import json
 import time
+import threading
 import warnings
 import traceback
 import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, contextmanager
+from functools import cached_property
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from .provider import PROVIDERS
+from .regrid import regrid, is_packed
+
+# Keep writing Zarr v2 stores with zarr >= 3, so minicubes stay readable with older zarr versions.
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3
+ZARR_KWARGS = {"zarr_format": 2} if ZARR_V3 else {}
 
 def compute_scale_and_offset(da, n=16):
     """Calculate offset and scale factor for int conversion
@@ -29,6 +50,10 @@ def compute_scale_and_offset(da, n=16):
     vmin = np.nanmin(da).item()
     vmax = np.nanmax(da).item()
 
+    return scale_and_offset_from_range(vmin, vmax, n = n)
+
+def scale_and_offset_from_range(vmin, vmax, n=16):
+
     # stretch/compress data to the available packed range
     scale_factor = (vmax - vmin) / (2 ** n - 1)
 
@@ -37,14 +62,112 @@ def compute_scale_and_offset(da, n=16):
 
     return scale_factor, add_offset
 
+def variable_statistics(data):
+    """Returns (nanmin, nanmax) of a NumPy or dask array, both NaN for all-NaN data."""
+    if isinstance(data, dask.array.Array):
+        return dask.array.nanmin(data), dask.array.nanmax(data)
+    return np.fmin.reduce(data, axis = None), np.fmax.reduce(data, axis = None)
+
+def encoding_statistics(minicube, variables, n_threads = None):
+    """Returns (min, max) of each variable, ignoring NaNs.
+
+    The statistics of all dask-backed variables are computed in a single dask.compute, so the cube is not recomputed per variable and statistic. NumPy-backed variables are reduced in parallel on a thread pool.
+    """
+
+    lazy = {v: variable_statistics(minicube[v].data) for v in variables if isinstance(minicube[v].data, dask.array.Array)}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category = RuntimeWarning)
+        stats = dask.compute(lazy)[0] if len(lazy) > 0 else {}
+
+    eager = [v for v in variables if v not in lazy]
+    with ThreadPoolExecutor(max_workers = n_threads) as executor:
+        stats.update(zip(eager, executor.map(lambda v: variable_statistics(minicube[v].values), eager)))
+
+    return {v: (float(vmin), float(vmax)) for v, (vmin, vmax) in stats.items()}
+
+@contextmanager
+def blosc_threads(n_threads = None):
+    """Lets Blosc compress with n_threads threads, also outside the main thread, and restores the previous process-wide Blosc settings afterwards. Does nothing if n_threads is None."""
+    if not n_threads:
+        yield
+        return
+    old_n_threads, old_use_threads = numcodecs.blosc.get_nthreads(), numcodecs.blosc.use_threads
+    numcodecs.blosc.set_nthreads(n_threads)
+    numcodecs.blosc.use_threads = True
+    try:
+        yield
+    finally:
+        numcodecs.blosc.set_nthreads(old_n_threads)
+        numcodecs.blosc.use_threads = old_use_threads
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB, or None where the resource module is unavailable."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+def assemble_cube(products):
+    """Assembles regridded product cubes into a single dataset.
+
+    Instead of merging cube by cube, the pieces of each variable are concatenated along time once and all temporal variables are then aligned on the union of their time stamps.
+    """
+
+    pieces = {}
+    for product in products:
+        for v in product.data_vars:
+            pieces.setdefault(v, []).append(product[v])
+
+    data_vars = {}
+    for v, arrays in pieces.items():
+        if (len(arrays) == 1) or ("time" not in arrays[0].dims):
+            data_vars[v] = arrays[0]
+        else:
+            data_vars[v] = xr.concat(arrays, dim = "time", coords = "minimal", compat = "override", join = "override")
+
+    times = [data_vars[v].time.values for v in data_vars if "time" in data_vars[v].dims]
+    if len(times) > 0:
+        time_index = np.unique(np.concatenate(times))
+        for v in data_vars:
+            if ("time" in data_vars[v].dims) and not np.array_equal(data_vars[v].time.values, time_index):
+                data_vars[v] = data_vars[v].reindex(time = time_index, fill_value = data_vars[v].attrs["_FillValue"] if is_packed(data_vars[v]) else np.nan)
+
+    return xr.Dataset(data_vars)
+
+def union_bbox(bboxes):
+    """Smallest (min_lon, min_lat, max_lon, max_lat) bbox containing all bboxes."""
+    bboxes = np.array(bboxes)
+    return (bboxes[:,0].min(), bboxes[:,1].min(), bboxes[:,2].max(), bboxes[:,3].max())
+
+def cube_attrs():
+    return {
+        "history": f"Created on {datetime.datetime.now()} with the earthnet-minicuber Python package. See https://github.com/earthnet2021/earthnet-minicuber"
+    }
+
+def unpack(ds):
+    """Decodes the packed variables (see is_packed) of ds to float32. Returns the decoded dataset and the encoding that packs them again on writing, which is needed to append to existing Zarr variables."""
+
+    ds = ds.copy()
+    encoding = {}
+    for v in ds.data_vars:
+        if is_packed(ds[v]):
+            attrs = dict(ds[v].attrs)
+            encoding[v] = {"dtype": ds[v].dtype.name, **{k: attrs.pop(k) for k in ["scale_factor", "add_offset", "_FillValue"] if k in attrs}}
+            ds[v] = (ds[v].where(ds[v] != encoding[v]["_FillValue"]) * encoding[v].get("scale_factor", 1.0) + encoding[v].get("add_offset", 0.0)).astype("float32")
+            ds[v].attrs = attrs
+    return ds, encoding
+
 class Minicuber:
 
-    def __init__(self, specs):
+    def __init__(self, specs, providers = None):
         self.specs = specs
 
         self.lon_lat = specs["lon_lat"]
         self.xy_shape = specs["xy_shape"]
         self.resolution = specs["resolution"]
+        self.read_resolution = specs.get("read_resolution", None)
+        self.warp_on_read = specs.get("warp_on_read", False)
         self.time_interval = specs["time_interval"]
         if "full_time_interval" in specs:
             self.full_time_interval = specs["full_time_interval"]
@@ -54,11 +177,15 @@ class Minicuber:
         if "primary_provider" in specs:
             specs["providers"] =  [specs["primary_provider"]] + specs["other_providers"]
 
-        self.providers = [PROVIDERS[p["name"]](**p["kwargs"]) for p in specs["providers"]]
+        if providers is None:
+            providers = [PROVIDERS[p["name"]](**p["kwargs"]) for p in specs["providers"]]
+        self.providers = providers
 
         self.temporal_providers = [p for p in self.providers if p.is_temporal]
         self.spatial_providers = [p for p in self.providers if not p.is_temporal]
 
+        self.projected_grids = {}
+
 
     @property
     def monthly_intervals(self):
@@ -78,7 +205,7 @@ class Minicuber:
         monthly_intervals.append(monthstart.strftime('%Y-%m-%d') + "/" + end.strftime('%Y-%m-%d'))
         return monthly_intervals
 
-    @property
+    @cached_property
     def bbox(self):
 
         utm_epsg = int(query_utm_crs_info(
@@ -98,7 +225,7 @@ class Minicuber:
 
         return transformer.transform_bounds(x_left, y_bottom, x_right, y_top, direction = 'INVERSE') # left, bottom, right, top
 
-    @property
+    @cached_property
     def padded_bbox(self):
         left, bottom, right, top = self.bbox
         lat_extra = (top - bottom) / self.xy_shape[0] * 6
@@ -106,7 +233,7 @@ class Minicuber:
         return left - lon_extra, bottom - lat_extra, right + lon_extra, top + lat_extra
 
 
-    @property
+    @cached_property
     def lon_lat_grid(self):
         nx, ny = self.xy_shape
         lon_left, lat_bottom, lon_right, lat_top = self.bbox
@@ -116,162 +243,530 @@ class Minicuber:
 
         return lon_grid, lat_grid
 
+    @property
+    def read_grid(self):
+        """The lon_lat_grid if products are warped onto it while reading, else None."""
+        return self.lon_lat_grid if self.warp_on_read else None
+
+    def projected_lon_lat_grid(self, epsg):
+        """The target lon_lat_grid transformed to the coordinates of epsg, cached per epsg."""
+        if epsg not in self.projected_grids:
+            transformer = Transformer.from_crs(4326, epsg, always_xy=True)
+            lon_grid, lat_grid = self.lon_lat_grid
+            self.projected_grids[epsg] = transformer.transform(lon_grid, lat_grid)
+        return self.projected_grids[epsg]
+
     def regrid_product_cube(self, product_cube):
 
         if ("x" in product_cube.coords) and ("y" in product_cube.coords):
+            xdim, ydim = "x", "y"
+            new_x, new_y = self.projected_lon_lat_grid(product_cube.attrs["epsg"])
+        elif ("lat" in product_cube.coords) and ("lon" in product_cube.coords):
+            xdim, ydim = "lon", "lat"
+            new_x, new_y = self.lon_lat_grid
+        else:
+            product_cube.attrs = {}
+            return product_cube
+
+        product_cube_nearest = product_cube.filter_by_attrs(interpolation_type=lambda v: ((v is None) or (v == "nearest")))
+        product_cube_linear = product_cube.filter_by_attrs(interpolation_type="linear")
+        if len(product_cube_nearest) > 0:
+            product_cube_nearest = regrid(product_cube_nearest, new_x, new_y, method = "nearest", xdim = xdim, ydim = ydim)
+        if len(product_cube_linear) > 0:
+            product_cube_linear = regrid(product_cube_linear, new_x, new_y, method = "linear", xdim = xdim, ydim = ydim)
+        if (len(product_cube_nearest) > 0) and (len(product_cube_linear) > 0):
+            product_cube = xr.merge([product_cube_nearest, product_cube_linear])
+        elif (len(product_cube_linear) > 0):
+            product_cube = product_cube_linear
+        else:
+            product_cube = product_cube_nearest
+
+        if xdim == "x":
+            lon_grid, lat_grid = self.lon_lat_grid
+            product_cube["x"], product_cube["y"] = lon_grid, lat_grid
+            product_cube = product_cube.rename({"x": "lon", "y": "lat"})
+        
+        product_cube.attrs = {}
 
-            x, y = product_cube.x.values, product_cube.y.values
+        return product_cube
 
-            product_epsg = product_cube.attrs["epsg"]
 
-            transformer = Transformer.from_crs(4326, product_epsg, always_xy=True)
 
-            lon_grid, lat_grid = self.lon_lat_grid
+    def cut_out(self, product_cube):
+        """Cuts the padded bbox of this minicube (plus 2 pixels) out of product_cube, which was loaded for a larger bbox, and regrids it. None if the product does not cover the minicube."""
 
-            new_x, new_y = transformer.transform(lon_grid, lat_grid)
-
-            
-            product_cube_nearest = product_cube.filter_by_attrs(interpolation_type=lambda v: ((v is None) or (v == "nearest")))
-            product_cube_linear = product_cube.filter_by_attrs(interpolation_type="linear")
-            if len(product_cube_nearest) > 0:
-                product_cube_nearest = product_cube_nearest.interp(x = new_x, y = new_y, method = "nearest")
-            if len(product_cube_linear) > 0:
-                product_cube_linear = product_cube_linear.interp(x = new_x, y = new_y, method = "linear")
-            if (len(product_cube_nearest) > 0) and (len(product_cube_linear) > 0):
-                product_cube = xr.merge([product_cube_nearest, product_cube_linear])
-            elif (len(product_cube_linear) > 0):
-                product_cube = product_cube_linear
-            else:
-                product_cube = product_cube_nearest
-            
+        if ("x" in product_cube.coords) and ("y" in product_cube.coords):
+            xdim, ydim = "x", "y"
+            left, bottom, right, top = Transformer.from_crs(4326, product_cube.attrs["epsg"], always_xy=True).transform_bounds(*self.padded_bbox)
+        elif ("lat" in product_cube.coords) and ("lon" in product_cube.coords):
+            xdim, ydim = "lon", "lat"
+            left, bottom, right, top = self.padded_bbox
+        else:
+            return self.regrid_product_cube(product_cube.copy())
 
-            product_cube["x"], product_cube["y"] = lon_grid, lat_grid
+        window = {}
+        for dim, low, high in [(xdim, left, right), (ydim, bottom, top)]:
+            coords = product_cube[dim].values
+            inside = np.flatnonzero((coords >= low) & (coords <= high))
+            if len(inside) == 0:
+                return None
+            window[dim] = slice(max(inside.min() - 2, 0), inside.max() + 3)
 
-            product_cube = product_cube.rename({"x": "lon", "y": "lat"})
+        return self.regrid_product_cube(product_cube.isel(window))
 
-        elif ("lat" in product_cube.coords) and ("lon" in product_cube.coords):
-            lon_grid, lat_grid = self.lon_lat_grid
-            product_cube_nearest = product_cube.filter_by_attrs(interpolation_type=lambda v: ((v is None) or (v == "nearest")))
-            if len(product_cube_nearest) > 0:
-                product_cube_nearest = product_cube_nearest.interp(lon = lon_grid, lat = lat_grid, method = "nearest")
-            product_cube_linear = product_cube.filter_by_attrs(interpolation_type="linear")
-            if len(product_cube_linear) > 0:
-                product_cube_linear = product_cube_linear.interp(lon = lon_grid, lat = lat_grid, method = "linear")
-            if (len(product_cube_nearest) > 0) and (len(product_cube_linear) > 0):
-                product_cube = xr.merge([product_cube_nearest, product_cube_linear])
-            elif (len(product_cube_linear) > 0):
-                product_cube = product_cube_linear
-            else:
-                product_cube = product_cube_nearest
-        
-        product_cube.attrs = {}
+    def plan_provider(self, provider):
+        provider.plan(self.padded_bbox, self.time_interval, full_time_interval = self.full_time_interval)
+
+    def load_product(self, provider, time_interval = None, compute = False, verbose = True):
+
+        if time_interval is None:
+            if verbose:
+                print(f"Loading {provider.__class__.__name__}")
+            product_cube = provider.load_data(self.padded_bbox, "not_needed", resolution = self.read_resolution, grid = self.read_grid)
+        else:
+            if verbose:
+                print(f"Loading {provider.__class__.__name__} for {time_interval}")
+            product_cube = provider.load_data(self.padded_bbox, time_interval, full_time_interval = self.full_time_interval, resolution = self.read_resolution, grid = self.read_grid)
+
+        if product_cube is None:
+            if verbose:
+                print(f"Skipping {provider.__class__.__name__}{'' if time_interval is None else f' for {time_interval}'} - no data found.")
+            return None
+
+        product_cube = self.regrid_product_cube(product_cube)
+
+        if compute:
+            product_cube = product_cube.compute()
 
         return product_cube
 
+    def load_products_concurrent(self, n_workers, max_workers_per_provider = None, compute = False, verbose = True):
+        """Runs all (provider, interval) jobs and the spatial providers on a thread pool.
+
+        Returns a dict mapping each monthly interval to its list of regridded product cubes (in provider order) and the list of regridded spatial product cubes.
+        """
+
+        semaphores = {id(p): threading.BoundedSemaphore(max_workers_per_provider) for p in self.providers} if max_workers_per_provider else {}
+
+        def run(provider, time_interval):
+            with semaphores.get(id(provider), nullcontext()):
+                return self.load_product(provider, time_interval, compute = compute, verbose = verbose)
+
+        def run_sequential(provider):
+            return {time_interval: run(provider, time_interval) for time_interval in self.monthly_intervals}
 
+        with ThreadPoolExecutor(max_workers = n_workers) as executor:
+            list(executor.map(self.plan_provider, self.providers))
+
+            # Sequential providers run all their intervals in order as one chained job.
+            sequential_futures = {id(provider): executor.submit(run_sequential, provider) for provider in self.temporal_providers if provider.is_sequential}
+            temporal_futures = {time_interval: [None if provider.is_sequential else executor.submit(run, provider, time_interval) for provider in self.temporal_providers] for time_interval in self.monthly_intervals}
+            spatial_futures = [executor.submit(run, provider, None) for provider in self.spatial_providers]
+
+            sequential_products = {k: f.result() for k, f in sequential_futures.items()}
+            temporal_products = {time_interval: [sequential_products[id(provider)][time_interval] if f is None else f.result() for provider, f in zip(self.temporal_providers, futures)] for time_interval, futures in temporal_futures.items()}
+            spatial_products = [f.result() for f in spatial_futures]
+
+        return temporal_products, spatial_products
 
     @classmethod
-    def load_minicube(cls, specs, verbose = True, compute = False):
+    def load_minicube(cls, specs, verbose = True, compute = False, n_workers = 1, max_workers_per_provider = None):
+        """Loads a minicube.
+
+        With n_workers > 1, all (provider, monthly interval) jobs and the spatial providers are run concurrently on a thread pool with n_workers threads, at most max_workers_per_provider of them for any single provider. The result is the same as with serial loading.
+        """
 
         self = cls(specs)
 
+        return self.load(verbose = verbose, compute = compute, n_workers = n_workers, max_workers_per_provider = max_workers_per_provider)
+
+    def load(self, verbose = True, compute = False, n_workers = 1, max_workers_per_provider = None):
+
         if not compute and (len(self.monthly_intervals) > 3):
             warnings.warn("You are querying a long time interval with compute = False, this might lead to failure in the dask sheduler and high memory consumption upon calling .compute(). Consider using compute = True instead.")
 
         warnings.filterwarnings('ignore')
 
-        all_data = []
-        cube = None
+        if n_workers and n_workers > 1:
+            temporal_products, spatial_products = self.load_products_concurrent(n_workers, max_workers_per_provider = max_workers_per_provider, compute = compute, verbose = verbose)
+        else:
+            for provider in self.providers:
+                self.plan_provider(provider)
+            temporal_products, spatial_products = None, None
+
+        products = []
         for time_interval in self.monthly_intervals:
 
-            for provider in self.temporal_providers:
+            if temporal_products is not None:
+                products += [p for p in temporal_products[time_interval] if p is not None]
+            else:
+                products += self.load_interval(time_interval, compute = compute, verbose = verbose)
 
-                if verbose:
-                    print(f"Loading {provider.__class__.__name__} for {time_interval}")
+        for i, provider in enumerate(self.spatial_providers):
+            if spatial_products is not None:
+                product_cube = spatial_products[i]
+            else:
+                product_cube = self.load_product(provider, verbose = verbose)
+            if product_cube is not None:
+                products.append(product_cube)
 
-                product_cube = provider.load_data(self.padded_bbox, time_interval, full_time_interval = self.full_time_interval)
+        starttime = time.time()
 
-                if product_cube is not None:
-                    if cube is None:
-                        cube = self.regrid_product_cube(product_cube)
-                    else:
-                        cube = xr.merge([cube, self.regrid_product_cube(product_cube)])
-                else:
-                    if verbose:
-                        print(f"Skipping {provider.__class__.__name__} for {time_interval} - no data found.")
-            
-            if cube is not None:
-                if compute:
-                    if verbose:
-                        print(f"Downloading for {time_interval}...")
-                    all_data.append(cube.compute())
-                else:
-                    all_data.append(cube)
-            cube = None
-        
-        cube = xr.merge(all_data, combine_attrs = 'override')
+        cube = assemble_cube(products)
 
-        for provider in self.spatial_providers:
-            if verbose:
-                print(f"Loading {provider.__class__.__name__}")
-            product_cube = provider.load_data(self.padded_bbox, "not_needed")
-            if product_cube is not None:
-                if cube is None:
-                    cube = self.regrid_product_cube(product_cube)
-                else:
-                    cube = xr.merge([cube, self.regrid_product_cube(product_cube)])
-            else:
-                if verbose:
-                    print(f"Skipping {provider.__class__.__name__} - no data found.")
+        if verbose:
+            peak_memory = peak_memory_mb()
+            print(f"Assembled {len(products)} product cubes in {time.time()-starttime:.2f} seconds" + (f", peak memory {peak_memory:.0f} MB." if peak_memory else "."))
 
         if compute:
             cube = cube.compute()
         
+        cube = self.select_time(cube)
+
+        cube.attrs = cube_attrs()
+
+        return cube
+
+    def load_interval(self, time_interval, compute = False, verbose = True):
+        """Loads the regridded product cubes of all temporal providers for one monthly interval, computed together if compute."""
+
+        interval_products = []
+        for provider in self.temporal_providers:
+            product_cube = self.load_product(provider, time_interval, verbose = verbose)
+            if product_cube is not None:
+                interval_products.append(product_cube)
+
+        if compute and (len(interval_products) > 0):
+            if verbose:
+                print(f"Downloading for {time_interval}...")
+            interval_products = list(dask.compute(*interval_products))
+
+        return interval_products
+
+    def select_time(self, cube):
         if "time" in cube:
             cube['time'] = pd.DatetimeIndex(cube['time'].values)
 
             cube = cube.sel(time = slice(self.time_interval[:10], self.time_interval[-10:]))
-
-        cube.attrs = {
-            "history": f"Created on {datetime.datetime.now()} with the earthnet-minicuber Python package. See https://github.com/earthnet2021/earthnet-minicuber"
-        }
-
         return cube
 
+    def stream(self, savepath, verbose = True, **kwargs):
+        """Loads the minicube interval by interval and appends each computed interval along time to a staging Zarr store next to savepath, then saves it to savepath with save_minicube_zarr, to which kwargs (chunks, compressor, ...) are passed.
 
+        Only one monthly interval is held in memory at a time, so peak memory does not grow with the length of the time interval. Spatial providers are written once. In the staging store, temporal variables are float32 (packed integer variables keep their dtype); variables missing in an interval are filled with NaN (or the _FillValue of packed variables). The int16 packing of save_minicube_zarr needs the value range of the whole cube, so the staging store is read back chunk by chunk once all intervals are written, and the result is the same as with save_minicube_zarr.
+        """
 
-    @staticmethod
-    def save_minicube_netcdf(minicube, savepath):
+        warnings.filterwarnings('ignore')
 
         savepath = Path(savepath)
+        savepath.parents[0].mkdir(exist_ok=True, parents=True)
 
-        encoding = {}
-        for v in list(minicube.variables):
-            if v in ["time", "time_clim", "lat", "lon"]:
+        tmppath = savepath.with_name(savepath.name + ".stream")
+        if tmppath.exists():
+            shutil.rmtree(tmppath)
+
+        for provider in self.providers:
+            self.plan_provider(provider)
+
+        spatial_products = [self.load_product(provider, verbose = verbose) for provider in self.spatial_providers]
+        spatial_products = [p for p in spatial_products if p is not None]
+
+        lon_grid, lat_grid = self.lon_lat_grid
+        cube = assemble_cube(spatial_products).compute().assign_coords(lat = lat_grid, lon = lon_grid)
+        cube.attrs = cube_attrs()
+        cube, encoding = unpack(cube)
+        cube.to_zarr(tmppath, mode = "w", consolidated = False, encoding = encoding, **ZARR_KWARGS)
+
+        schema = {}
+        times = None
+        for time_interval in self.monthly_intervals:
+
+            starttime = time.time()
+
+            cube = assemble_cube(self.load_interval(time_interval, compute = True, verbose = verbose))
+            cube = self.select_time(cube)
+            if cube.sizes.get("time", 0) == 0:
                 continue
-            elif ("interpolation_type" in minicube[v].attrs) and (minicube[v].attrs["interpolation_type"] == "linear"):
-                scale_factor, add_offset = compute_scale_and_offset(minicube[v].values)
+
+            static_vars = [v for v in cube.data_vars if ("time" not in cube[v].dims) and (v not in schema)]
+            if len(static_vars) > 0:
+                static, encoding = unpack(cube[static_vars])
+                static.to_zarr(tmppath, mode = "a", consolidated = False, encoding = encoding, **ZARR_KWARGS)
+                schema.update({v: None for v in static_vars})
+
+            cube = cube[[v for v in cube.data_vars if "time" in cube[v].dims]]
+            cube = cube.drop_vars([c for c in cube.coords if c != "time"])
+
+            for v in list(cube.data_vars):
+                if not is_packed(cube[v]):
+                    cube[v] = cube[v].astype("float32")
+
+            def missing(dims, sizes, attrs, dtype):
+                return xr.DataArray(np.full([sizes[d] for d in dims], attrs["_FillValue"] if dtype.kind in "ui" else np.nan, dtype = dtype), dims = dims, attrs = attrs)
+
+            for v, var_schema in schema.items():
+                if (var_schema is not None) and (v not in cube):
+                    dims, attrs, dtype = var_schema
+                    cube[v] = missing(dims, cube.sizes, attrs, dtype)
+
+            new_vars = [v for v in cube.data_vars if v not in schema]
+            if (times is not None) and (len(new_vars) > 0):
+                fill, encoding = unpack(xr.Dataset({v: missing(cube[v].dims, {**cube.sizes, "time": len(times)}, cube[v].attrs, cube[v].dtype) for v in new_vars}, coords = {"time": times}))
+                fill.to_zarr(tmppath, mode = "a", consolidated = False, encoding = encoding, **ZARR_KWARGS)
+            schema.update({v: (cube[v].dims, cube[v].attrs, cube[v].dtype) for v in new_vars})
+
+            # Packed variables are written decoded, Zarr packs them again with the encoding of their first write.
+            cube, encoding = unpack(cube)
+
+            if times is None:
+                cube.to_zarr(tmppath, mode = "a", consolidated = False, encoding = {**encoding, "time": {"units": "seconds since 1970-01-01", "dtype": "float64"}}, **ZARR_KWARGS)
+                times = cube.time.values
+            else:
+                cube.to_zarr(tmppath, append_dim = "time", consolidated = False, **ZARR_KWARGS)
+                times = np.concatenate([times, cube.time.values])
+
+            if verbose:
+                peak_memory = peak_memory_mb()
+                print(f"Saved {time_interval} in {time.time()-starttime:.2f} seconds" + (f", peak memory {peak_memory:.0f} MB." if peak_memory else "."))
+
+            del cube
+
+        zarr.consolidate_metadata(str(tmppath))
+
+        # Packed variables stay packed, float variables get the packing of save_minicube_zarr.
+        with xr.open_zarr(tmppath, mask_and_scale = False) as minicube:
+            for v in minicube.data_vars:
+                if not is_packed(minicube[v]):
+                    minicube[v].attrs.pop("_FillValue", None)
+            minicube.attrs = cube_attrs()
+            self.save_minicube_zarr(minicube, savepath, **kwargs)
+
+        shutil.rmtree(tmppath)
+
+
+
+    @staticmethod
+    def cluster_specs(specs_list, cluster_size = 0.5):
+        """Groups specs that share providers and time intervals and whose centers fall into the same cluster_size x cluster_size degree cell.
+
+        Returns a list of lists of indices into specs_list.
+        """
+
+        clusters = {}
+        for i, specs in enumerate(specs_list):
+            providers = [specs["primary_provider"]] + specs["other_providers"] if "primary_provider" in specs else specs["providers"]
+            key = (
+                json.dumps(providers, sort_keys = True, default = str),
+                specs["time_interval"],
+                specs.get("full_time_interval", specs["time_interval"]),
+                int(np.floor(specs["lon_lat"][0] / cluster_size)),
+                int(np.floor(specs["lon_lat"][1] / cluster_size))
+            )
+            clusters.setdefault(key, []).append(i)
+
+        return list(clusters.values())
+
+    @classmethod
+    def load_minicubes(cls, specs_list, verbose = True, compute = True, cluster_size = 0.5, shared_reads = True, **kwargs):
+        """Loads many minicubes, sharing providers, catalog searches and reads between neighbouring cubes.
+
+        Specs are clustered by cluster_specs. Within each cluster, the providers are created once and plan a single search over the union of all padded bboxes and time intervals, from which every minicube gets its items. With shared_reads, each provider then loads every interval once for the union bbox and all minicubes are cut out of that product (see load_shared), else every minicube is loaded on its own with Minicuber.load, to which kwargs are passed. kwargs are not supported with shared_reads.
+
+        Yields (index into specs_list, minicube) tuples, ordered by cluster.
+        """
+
+        if shared_reads and (len(kwargs) > 0):
+            raise TypeError(f"load_minicubes got {sorted(kwargs)}, which are only used with shared_reads = False.")
+
+        for cluster in cls.cluster_specs(specs_list, cluster_size = cluster_size):
+
+            minicubers = [cls(specs_list[cluster[0]])]
+            minicubers += [cls(specs_list[i], providers = minicubers[0].providers) for i in cluster[1:]]
+
+            cluster_bbox = union_bbox([m.padded_bbox for m in minicubers])
+
+            time_interval = minicubers[0].time_interval
+            full_time_interval = minicubers[0].full_time_interval
+
+            if verbose:
+                print(f"Planning cluster of {len(cluster)} minicubes in bbox {cluster_bbox}")
+
+            for provider in minicubers[0].providers:
+                provider.plan(cluster_bbox, time_interval, full_time_interval = full_time_interval)
+
+            if shared_reads:
+                yield from zip(cluster, cls.load_shared(minicubers, verbose = verbose, compute = compute))
+            else:
+                for i, minicuber in zip(cluster, minicubers):
+                    yield i, minicuber.load(verbose = verbose, compute = compute, **kwargs)
+
+    @staticmethod
+    def read_groups(minicubers, provider, time_interval = None):
+        """Groups the minicubes of a cluster that can share a read of provider for time_interval.
+
+        A minicube joins a group if the items selected by the group that intersect it are all selected by it, and vice versa (see Provider.item_selection), so e.g. the Sentinel 2 best orbit and min_coverage filters still apply per minicube. Returns a list of (indices into minicubers, item ids to read or None for all).
+        """
+
+        selections = [provider.item_selection(m.padded_bbox, time_interval or "not_needed", full_time_interval = m.full_time_interval) for m in minicubers]
+        if all(s is None for s in selections):
+            return [(list(range(len(minicubers))), None)]
+
+        groups = []
+        for i, (candidates, selected) in enumerate(selections):
+            for members, item_ids in groups:
+                if ((item_ids & candidates) <= selected) and all((selected & selections[j][0]) <= selections[j][1] for j in members):
+                    members.append(i)
+                    item_ids.update(selected)
+                    break
+            else:
+                groups.append(([i], set(selected)))
+
+        return groups
+
+    @classmethod
+    def load_shared(cls, minicubers, verbose = True, compute = True):
+        """Loads the minicubes of one cluster (sharing providers and time intervals) from a single read per provider and interval.
+
+        Every provider loads each monthly interval (and spatial providers their data) once for the union of the padded bboxes of all minicubes that select the same items (see read_groups), usually the whole cluster. Each minicube cuts its own window out of that lazy product and regrids it, and with compute the cubes of an interval are computed together, so dask reads every chunk shared by several minicubes only once. Products are read on their native grid, warp_on_read is not used. Returns the list of minicubes.
+        """
+
+        warnings.filterwarnings('ignore')
+
+        lead = minicubers[0]
+
+        def cut_out(provider, time_interval = None):
+            cubes = [None] * len(minicubers)
+            for members, item_ids in cls.read_groups(minicubers, provider, time_interval):
+                if verbose:
+                    print(f"Loading {provider.__class__.__name__}{'' if time_interval is None else f' for {time_interval}'} for {len(members)} minicubes")
+                bbox = union_bbox([minicubers[i].padded_bbox for i in members])
+                item_kwargs = {} if item_ids is None else {"item_ids": item_ids}
+                if time_interval is None:
+                    product_cube = provider.load_data(bbox, "not_needed", resolution = lead.read_resolution, **item_kwargs)
+                else:
+                    product_cube = provider.load_data(bbox, time_interval, full_time_interval = lead.full_time_interval, resolution = lead.read_resolution, **item_kwargs)
+                if product_cube is not None:
+                    for i in members:
+                        cubes[i] = minicubers[i].cut_out(product_cube)
+            return cubes
+
+        products = [[] for _ in minicubers]
+        jobs = [(lead.temporal_providers, time_interval) for time_interval in lead.monthly_intervals] + [(lead.spatial_providers, None)]
+        for providers, time_interval in jobs:
+            job_products = [[] for _ in minicubers]
+            for provider in providers:
+                for cube_products, product_cube in zip(job_products, cut_out(provider, time_interval)):
+                    if product_cube is not None:
+                        cube_products.append(product_cube)
+
+            if compute and any(len(p) > 0 for p in job_products):
+                if verbose:
+                    print(f"Downloading{'' if time_interval is None else f' for {time_interval}'}...")
+                job_products = dask.compute(*job_products)
+
+            for cube_products, new_products in zip(products, job_products):
+                cube_products += list(new_products)
+
+        cubes = []
+        for minicuber, cube_products in zip(minicubers, products):
+            cube = minicuber.select_time(assemble_cube(cube_products))
+            cube.attrs = cube_attrs()
+            cubes.append(cube)
+
+        return cubes
+
+    @staticmethod
+    def packing_encoding(minicube):
+        """Returns the int16 scale/offset packing of each variable (an empty dict for variables stored unpacked), shared by the NetCDF and Zarr writers.
+
+        The statistics of all variables are computed in one pass with encoding_statistics.
+        """
+
+        variables = [v for v in minicube.variables if v not in ["time", "time_clim", "lat", "lon"]]
+
+        # Packed variables (see is_packed) already carry their scale_factor, add_offset and _FillValue.
+        encoding = {v: {} for v in variables if is_packed(minicube[v])}
+        variables = [v for v in variables if v not in encoding]
+
+        stats = encoding_statistics(minicube, variables)
+
+        for v in variables:
+            vmin, vmax = stats[v]
+            if ("interpolation_type" in minicube[v].attrs) and (minicube[v].attrs["interpolation_type"] == "linear"):
+                scale_factor, add_offset = scale_and_offset_from_range(vmin, vmax)
             else:
                 scale_factor, add_offset = 1.0, 0.0
                             
-            if abs(scale_factor) < 1e-8 or np.isnan(scale_factor) or (scale_factor == 1.0 and minicube[v].max() > 32766):
-                encoding[v] = {"zlib": True, "complevel": 9}
+            if abs(scale_factor) < 1e-8 or np.isnan(scale_factor) or (scale_factor == 1.0 and vmax > 32766):
+                encoding[v] = {}
             else:
                 encoding[v] =  {
                     "dtype": 'int16',
                     "scale_factor": scale_factor,
                     "add_offset": add_offset,
-                    "_FillValue": -32767,
-                    "zlib": True,
-                    "complevel": 9
+                    "_FillValue": -32767
                 }
+                # Integers (e.g. compact SCL and mask) are stored as int16 as they are, xarray cannot apply scale_factor and add_offset to them.
+                if minicube[v].dtype.kind in "ui":
+                    del encoding[v]["scale_factor"], encoding[v]["add_offset"]
+
+        return encoding
+
+    @classmethod
+    def save_minicube_netcdf(cls, minicube, savepath):
+
+        savepath = Path(savepath)
+
+        encoding = {v: {**e, "zlib": True, "complevel": 9} for v, e in cls.packing_encoding(minicube).items()}
 
         if savepath.is_file():
             savepath.unlink()
         else:
             savepath.parents[0].mkdir(exist_ok=True, parents=True)
 
-        minicube.to_netcdf(savepath, encoding = encoding, compute = True)
+        # Write to a temporary file first, so an interrupted job never leaves a truncated minicube at savepath.
+        tmppath = savepath.with_name(savepath.name + ".tmp")
+
+        minicube.to_netcdf(tmppath, encoding = encoding, compute = True)
+
+        os.replace(tmppath, savepath)
+
+    @classmethod
+    def save_minicube_zarr(cls, minicube, savepath, chunks = None, compressor = "zstd", clevel = 5, shuffle = True, n_threads = None, consolidated = True):
+        """Saves a minicube to a Zarr store with the same int16 packing as save_minicube_netcdf.
+
+        chunks maps dimension names to chunk sizes (default: 8 time steps, full extent along all other dimensions). compressor is a Blosc codec name (zstd, lz4, lz4hc, blosclz, zlib), a numcodecs codec or None. With n_threads, Blosc compresses each chunk with n_threads threads, also outside the main thread, for the duration of the save (see blosc_threads).
+        """
+
+        savepath = Path(savepath)
+
+        chunks = {"time": 8, **(chunks if chunks is not None else {})}
+
+        if isinstance(compressor, str):
+            compressor = numcodecs.Blosc(cname = compressor, clevel = clevel, shuffle = numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE)
+
+        compressor_encoding = {"compressors": (compressor,) if compressor is not None else None} if ZARR_V3 else {"compressor": compressor}
+
+        encoding = {}
+        for v, e in cls.packing_encoding(minicube).items():
+            encoding[v] = {**e, **compressor_encoding, "chunks": tuple(min(chunks.get(d, n), n) for d, n in minicube[v].sizes.items())}
+
+        if minicube.chunks:
+            minicube = minicube.chunk({d: min(c, minicube.sizes[d]) for d, c in chunks.items() if d in minicube.dims})
+
+        savepath.parents[0].mkdir(exist_ok=True, parents=True)
+
+        # Write to a temporary store first, so an interrupted job never leaves an incomplete minicube at savepath.
+        tmppath = savepath.with_name(savepath.name + ".tmp")
+        if tmppath.exists():
+            shutil.rmtree(tmppath)
+
+        with blosc_threads(n_threads):
+            minicube.to_zarr(tmppath, mode = "w", encoding = encoding, consolidated = consolidated, compute = True, **ZARR_KWARGS)
+
+        if savepath.exists():
+            shutil.rmtree(savepath)
+        os.replace(tmppath, savepath)
 
     @classmethod
     def save_minicube(cls, specs, savepath, verbose = True):
@@ -286,11 +781,39 @@ class Minicuber:
         if verbose:
             print(f"Saving minicube at {specs['lon_lat']}")
 
-        cls.save_minicube_netcdf(minicube, savepath)
+        cls.save_minicube_file(minicube, savepath)
+
+    @classmethod
+    def save_minicube_file(cls, minicube, savepath):
+        """Saves a minicube as Zarr if savepath ends with .zarr, otherwise as NetCDF."""
+        if str(savepath).endswith(".zarr"):
+            cls.save_minicube_zarr(minicube, savepath)
+        else:
+            cls.save_minicube_netcdf(minicube, savepath)
+
+    @classmethod
+    def save_minicube_stream(cls, specs, savepath, verbose = True, **kwargs):
+        """Saves a minicube to a Zarr store, appending one monthly interval at a time (see Minicuber.stream). kwargs are passed to save_minicube_zarr."""
+
+        if verbose:
+            print(f"Streaming minicube at {specs['lon_lat']}")
+
+        cls(specs).stream(savepath, verbose = verbose, **kwargs)
+
+    @classmethod
+    def save_minicubes(cls, specs_list, savepaths, verbose = True, **kwargs):
+        """Loads minicubes in batches with load_minicubes and saves each to its entry of savepaths."""
+
+        for i, minicube in cls.load_minicubes(specs_list, verbose = verbose, compute = True, **kwargs):
+
+            if verbose:
+                print(f"Saving minicube at {specs_list[i]['lon_lat']}")
 
+            cls.save_minicube_file(minicube, savepaths[i])
 
     @classmethod
     def save_minicube_mp(cls, pars):
+        warnings.warn("save_minicube_mp is deprecated, use earthnet_minicuber.MinicubeRunner instead.", DeprecationWarning)
         starttime = time.time()
         time.sleep(random.uniform(0,2))
         done = False
@@ -1,5 +1,5 @@
 
-from . import provider_base, s2, sentinel1, ndviclim, srtm, esawc, era5, soilgrids, geomorphons, landsat, cop30, alos, era5_esdl, nasadem
+from . import provider_base, item_cache, stac_utils, s2, sentinel1, ndviclim, srtm, esawc, era5, soilgrids, geomorphons, landsat, cop30, alos, era5_esdl, nasadem
 
 PROVIDERS = {
     "s2": s2.sentinel2.Sentinel2,
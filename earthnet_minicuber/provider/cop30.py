@@ -1,15 +1,12 @@
 
 import os
 import pystac_client
-import stackstac
 import rasterio
 import xarray as xr
 import numpy as np
-import planetary_computer as pc
-import time
-import random
 
-from . import provider_base
+from . import provider_base, stac_utils
+from .mosaic import mosaic
 
 
 class Copernicus30(provider_base.Provider):
@@ -21,26 +18,22 @@ class Copernicus30(provider_base.Provider):
         URL = "https://planetarycomputer.microsoft.com/api/stac/v1/"
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items, sign = True)
+
+
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, ["cop-dem-glo-30"], name = "COP30 Dem")
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, None)
 
     def load_data(self, bbox, time_interval, **kwargs):
         
         stack = None
 
-        search = self.catalog.search(
-                bbox = bbox,
-                collections=["cop-dem-glo-30"]
-            )
-            
-        for attempt in range(10):
-            try:
-                items_dem = pc.sign(search)
-            except pystac_client.exceptions.APIError:
-                print(f"COP30 Dem: Planetary computer time out, attempt {attempt}, retrying in 60 seconds...")
-                time.sleep(random.uniform(30,90))
-            else:
-                break
-        else:
-            print("Loading COP30 DEM failed after 10 attempts...")
+        items_dem = self.planner.get_items(bbox, None)
+
+        if items_dem is None:
             return None
 
         if len(items_dem.to_dict()['features']) == 0:
@@ -49,11 +42,12 @@ class Copernicus30(provider_base.Provider):
         metadata = items_dem.to_dict()['features'][0]["properties"]
         epsg = metadata["proj:epsg"]
 
-        stack = stackstac.stack(items_dem, epsg = epsg, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 512)
+        stack = stac_utils.stack(items_dem, epsg, bbox, resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 512)
+        epsg = stack.attrs["epsg"]
 
         stack["band"] = ["cop_dem"]
 
-        stack = stack.median("time")
+        stack = mosaic(stack, "first")
 
         stack = stack.to_dataset("band")
 
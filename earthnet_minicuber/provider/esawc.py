@@ -1,16 +1,13 @@
 
 import os
 import pystac_client
-import stackstac
 import rasterio
 import xarray as xr
 import numpy as np
 from contextlib import nullcontext
-import planetary_computer as pc
-import time
-import random
 
-from . import provider_base
+from . import provider_base, stac_utils
+from .mosaic import mosaic
 
 
 class ESAWorldcover(provider_base.Provider):
@@ -29,9 +26,17 @@ class ESAWorldcover(provider_base.Provider):
 
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items, sign = (self.aws_bucket == "planetary_computer"))
+
         os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
 
 
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, ["esa_worldcover" if self.aws_bucket == "dea" else "esa-worldcover"], name = "ESAWC")
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, None)
+
     def load_data(self, bbox, time_interval, **kwargs):
 
         if self.aws_bucket == "dea":
@@ -44,26 +49,10 @@ class ESAWorldcover(provider_base.Provider):
 
             stack = None
 
-            # if "dem" in self.bands:
-            search = self.catalog.search(
-                    bbox = bbox,
-                    collections=["esa_worldcover" if self.aws_bucket == "dea" else "esa-worldcover"]
-                )
-
-            if self.aws_bucket == "planetary_computer":
-                for attempt in range(10):
-                    try:
-                        items_esawc = pc.sign(search)
-                    except pystac_client.exceptions.APIError:
-                        print(f"ESAWC: Planetary computer time out, attempt {attempt}, retrying in 60 seconds...")
-                        time.sleep(random.uniform(30,90))
-                    else:
-                        break
-                else:
-                    print("Loading ESAWC failed after 10 attempts...")
-                    return None
-            else:
-                items_esawc = search.get_all_items()
+            items_esawc = self.planner.get_items(bbox, None)
+
+            if items_esawc is None:
+                return None
 
             if len(items_esawc.to_dict()['features']) == 0:
                 return None
@@ -71,11 +60,12 @@ class ESAWorldcover(provider_base.Provider):
             metadata = items_esawc.to_dict()['features'][0]["properties"]
             epsg = metadata["proj:epsg"]
 
-            stack = stackstac.stack(items_esawc, epsg = epsg, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 1024)
+            stack = stac_utils.stack(items_esawc, epsg, bbox, resampling = "nearest", resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 1024)
+            epsg = stack.attrs["epsg"]
             stack["band"] = ["lc"]
 
 
-            stack = stack.median("time")
+            stack = mosaic(stack, "first")
 
             stack["band"] = [f"esawc_{b}" for b in stack.band.values]
 
@@ -0,0 +1,89 @@
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+
+import pystac
+
+
+class ItemCache:
+    """Persistent on-disk cache of STAC search results.
+
+    Each search result is stored as a serialized (unsigned) ItemCollection in its own JSON file inside cachedir. Entries older than ttl seconds are treated as missing. If the cache grows beyond max_size bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cachedir, ttl = 7 * 24 * 3600, max_size = 2 ** 30):
+        self.cachedir = Path(cachedir)
+        self.cachedir.mkdir(exist_ok = True, parents = True)
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(endpoint, collections, bbox, datetime):
+        query = json.dumps({"endpoint": endpoint, "collections": sorted(collections), "bbox": [round(float(b), 8) for b in bbox], "datetime": datetime})
+        return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = self.cachedir/f"{key}.json"
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if (self.ttl is not None) and (time.time() - entry["created"] > self.ttl):
+            path.unlink(missing_ok = True)
+            return None
+
+        # The modification time marks the last access for LRU eviction.
+        os.utime(path)
+
+        return pystac.ItemCollection.from_dict(entry["items"])
+
+    def put(self, key, items):
+        entry = {"created": time.time(), "items": items.to_dict()}
+
+        fd, tmppath = tempfile.mkstemp(dir = self.cachedir, suffix = ".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmppath, self.cachedir/f"{key}.json")
+
+        self.evict()
+
+    def evict(self):
+        if self.max_size is None:
+            return
+
+        entries = []
+        for path in self.cachedir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key = lambda e: e[0]):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok = True)
+            total -= size
+
+    def clear(self):
+        for path in self.cachedir.glob("*.json"):
+            path.unlink(missing_ok = True)
+
+
+ITEM_CACHE = None
+
+def set_item_cache(cachedir = None, **kwargs):
+    """Enables the process-wide STAC item cache in cachedir (see ItemCache for kwargs), or disables it if cachedir is None."""
+    global ITEM_CACHE
+    ITEM_CACHE = ItemCache(cachedir, **kwargs) if cachedir is not None else None
+    return ITEM_CACHE
+
+def get_item_cache():
+    return ITEM_CACHE
@@ -2,15 +2,16 @@
 
 import collections
 import os
+import pystac
 import pystac_client
-import stackstac
 import rasterio
 import numpy as np
 import xarray as xr
+import dask.array
+from scipy import ndimage
 
-import odc.algo
-
-from . import provider_base
+from . import provider_base, stac_utils
+from .mosaic import mosaic
 
 
 
@@ -82,7 +83,46 @@ def create_mask_value(bits_def, **flags):
             value = set_value_at_index(value, bit, flag_value)
 
     return mask, value
-    
+
+
+def qa_lookup_table(bits_def, **flags):
+    """Decodes every possible 16-bit QA value into a uint8 validity class (0 valid, 1 invalid): a value is invalid if any of the bits of flags (see create_mask_value) is set. The 65536 entry table is indexed with the QA values."""
+    mask, _ = create_mask_value(bits_def, **flags)
+    return ((np.arange(2**16, dtype = "uint32") & mask) != 0).astype("uint8")
+
+
+def disk(radius):
+    y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    return (x**2 + y**2) <= radius**2
+
+
+MORPH_OPS = {
+    "opening": lambda m, s: ndimage.binary_dilation(ndimage.binary_erosion(m, s, border_value = 1), s),
+    "closing": lambda m, s: ndimage.binary_erosion(ndimage.binary_dilation(m, s), s, border_value = 1),
+    "dilation": lambda m, s: ndimage.binary_dilation(m, s),
+    "erosion": lambda m, s: ndimage.binary_erosion(m, s, border_value = 1),
+}
+
+def qa_mask_kernel(qa, lut, mask_filters):
+    """Decodes a float QA block with lut (missing QA counts as no data) and applies the morphological mask_filters, a list of (operation, disk radius), to every 2D slice."""
+    qa = np.where(np.isfinite(qa), qa, 1).astype("uint16")
+    mask = lut[qa].astype(bool)
+    for op, radius in mask_filters:
+        mask = MORPH_OPS[op](mask, disk(radius).reshape((1,) * (mask.ndim - 2) + (2 * radius + 1, 2 * radius + 1)))
+    return mask.astype("uint8")
+
+
+def qa_mask(qa, lut, mask_filters = [("opening", 4), ("dilation", 6)]):
+    """uint8 mask (1 invalid) from the QA_PIXEL DataArray qa in one pass: decoding with lut and morphological cleanup. Dask-backed arrays stay lazy and are processed blockwise with a halo covering all mask_filters."""
+    qa = qa.transpose(..., "y", "x")
+
+    if qa.chunks is None:
+        return qa.copy(data = qa_mask_kernel(qa.values, lut, mask_filters))
+
+    halo = sum(2 * r if op in ["opening", "closing"] else r for op, r in mask_filters)
+    depth = {ax: 0 if len(qa.data.chunks[ax]) == 1 else halo for ax in [qa.ndim - 2, qa.ndim - 1]}
+    return qa.copy(data = dask.array.map_overlap(qa_mask_kernel, qa.data, depth = depth, boundary = "none", dtype = "uint8", lut = lut, mask_filters = mask_filters))
+
 
 class Landsat(provider_base.Provider):
 
@@ -154,6 +194,31 @@ class Landsat(provider_base.Provider):
         "ls9_sr": DESCRIPTIONS_89_sr
     }
 
+    # Band names shared by the Landsat 5/7 and 8/9 layouts, used in multi-sensor mode.
+    COMMON_BANDS_57 = {"blue": "SR_B1", "green": "SR_B2", "red": "SR_B3", "nir": "SR_B4", "swir1": "SR_B5", "swir2": "SR_B7", "lwir": "ST_B6", "QA_PIXEL": "QA_PIXEL"}
+    COMMON_BANDS_89 = {"coastal": "SR_B1", "blue": "SR_B2", "green": "SR_B3", "red": "SR_B4", "nir": "SR_B5", "swir1": "SR_B6", "swir2": "SR_B7", "lwir": "ST_B10", "QA_PIXEL": "QA_PIXEL"}
+
+    COMMON_BANDS_BY_SENSOR = {
+        "ls5": COMMON_BANDS_57,
+        "ls7": COMMON_BANDS_57,
+        "ls8": COMMON_BANDS_89,
+        "ls9": COMMON_BANDS_89
+    }
+
+    DEFAULT_BANDS_COMMON = {"sr": ["blue", "green", "red", "nir", "swir1", "swir2"], "st": ["lwir"]}
+
+    DESCRIPTIONS_COMMON = {
+        'coastal': 'Surface reflectance (Coastal Aerosol), Landsat 8/9 only',
+        'blue': 'Surface reflectance (Blue)',
+        'green': 'Surface reflectance (Green)',
+        'red': 'Surface reflectance (Red)',
+        'nir': 'Surface reflectance (Near-Infrared (NIR))',
+        'swir1': 'Surface reflectance (Short Wavelength Infrared (SWIR) 1)',
+        'swir2': 'Surface reflectance (SWIR 2)',
+        'lwir': 'Surface temperature (Thermal Infrared (TIR))',
+        'QA_PIXEL': 'Pixel quality'
+    }
+
     PIXELQ_FLAGS = {
                     "cirrus": {
                         "bits": 2,
@@ -191,39 +256,76 @@ class Landsat(provider_base.Provider):
                 }
 
 
-    def __init__(self, sensor = "ls8_sr", bands = ["SR_B1", "SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B6", "SR_B7"], cloud_mask = True, mask_kwargs = {"cloud": "high_confidence", # True where there is cloud
+    def __init__(self, sensor = "ls8_sr", bands = None, cloud_mask = True, mask_kwargs = {"cloud": "high_confidence", # True where there is cloud
                 #cirrus="high_confidence",# True where there is cirrus cloud
                 "cloud_shadow":"high_confidence",# True where there is cloud shadow
                 "dilated_cloud": "dilated",
                 "nodata": True}, ls_avail_var = True):
         self.is_temporal = True
-        
-        self.sensor = sensor
+
+        # A list of sensors (e.g. ["ls5_sr", "ls7_sr", "ls8_sr", "ls9_sr"]) selects multi-sensor mode: bands are common names (see COMMON_BANDS_89) and variables are named ls_sr_<band>.
+        self.multi_sensor = not isinstance(sensor, str)
+        self.sensors = list(sensor) if self.multi_sensor else [sensor]
+        if len(set(s[4:] for s in self.sensors)) > 1:
+            raise ValueError(f"Sensors {self.sensors} mix surface reflectance (_sr) and surface temperature (_st) collections, use only one of them.")
+        self.sensor = f"ls_{self.sensors[0][4:]}" if self.multi_sensor else sensor
+        self.provider_name = f"Landsat {'/'.join(s[2] for s in self.sensors)} {self.sensors[0][4:].upper()}"
+
+        if bands is None:
+            bands = self.DEFAULT_BANDS_COMMON[self.sensors[0][4:]] if self.multi_sensor else ["SR_B1", "SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B6", "SR_B7"]
+
+        if self.multi_sensor:
+            unknown = [b for b in bands if b not in self.COMMON_BANDS_89]
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown bands {unknown} for multi-sensor Landsat, choose from {list(self.COMMON_BANDS_89)}.")
+
         if cloud_mask and ("QA_PIXEL" not in bands):
-            bands.append("QA_PIXEL")
+            bands = bands + ["QA_PIXEL"]
             self.drop_qa = True
         else:
             self.drop_qa = False
         self.bands = bands
         self.cloud_mask = cloud_mask
         self.mask_kwargs = mask_kwargs
+        self.qa_lut = qa_lookup_table(self.PIXELQ_FLAGS, **mask_kwargs) if cloud_mask else None
         self.ls_avail_var = ls_avail_var
 
         URL = "https://explorer.digitalearth.africa/stac/"
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items)
+
         os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
         os.environ['AWS_S3_ENDPOINT'] = 's3.af-south-1.amazonaws.com'
 
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, self.sensors, datetime = time_interval, name = "Landsat")
+
+    def harmonize_items(self, items):
+        """Copies of items whose assets are renamed from the band names of their sensor to the common names in self.bands, so items of all sensors stack together."""
+        harmonized = []
+        for item in items:
+            names = self.COMMON_BANDS_BY_SENSOR[item.collection_id[:3]]
+            item = item.clone()
+            item.assets = {b: item.assets[names[b]] for b in self.bands if (b in names) and (names[b] in item.assets)}
+            harmonized.append(item)
+        return pystac.ItemCollection(harmonized)
+
+    def band_name(self, band):
+        if self.multi_sensor or (band == "QA_PIXEL"):
+            return f"{self.sensor}_{band}"
+        return f"{self.sensor}_{band.split('_')[1]}"
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, time_interval)
 
     def load_data(self, bbox, time_interval, **kwargs):
         
         with rasterio.Env(aws_unsigned = True, AWS_S3_ENDPOINT= 's3.af-south-1.amazonaws.com'):
-            items_ls = self.catalog.search(
-                    bbox = bbox,
-                    collections=[self.sensor],
-                    datetime=time_interval
-                ).get_all_items()
+            items_ls = self.planner.get_items(bbox, time_interval)
+
+            if items_ls is None:
+                return None
             
             if len(items_ls.to_dict()['features']) == 0:
                 return None
@@ -231,51 +333,44 @@ class Landsat(provider_base.Provider):
             metadata = items_ls.to_dict()['features'][0]["properties"]
             epsg = metadata["proj:epsg"]
 
-            stack = stackstac.stack(items_ls, epsg = epsg, assets = self.bands, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 1024)
+            if self.multi_sensor:
+                items_ls = self.harmonize_items(items_ls)
 
+            stack = stac_utils.stack(items_ls, epsg, bbox, assets = self.bands, nearest_assets = ["QA_PIXEL"], resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 1024)
+            epsg = stack.attrs["epsg"]
 
-            ls_bands = [f"{self.sensor}_{b.split('_')[1] if b!= 'QA_PIXEL' else b}" for b in stack.band.values]
+
+            ls_bands = [self.band_name(b) for b in stack.band.values]
             stack["band"] = ls_bands
 
             stack = stack.to_dataset("band")
 
             if self.cloud_mask:
-                mask, _ = create_mask_value(
-                    self.PIXELQ_FLAGS, **self.mask_kwargs
-                )
-                
-                pq_mask = (stack[f"{self.sensor}_QA_PIXEL"].astype("uint16") & mask) != 0
-
-                pq_mask = odc.algo.mask_cleanup(pq_mask, mask_filters=[("opening", 4),("dilation", 6)])
-
-                stack[f"{self.sensor}_mask"] = pq_mask.astype("uint8")
+                stack[f"{self.sensor}_mask"] = qa_mask(stack[f"{self.sensor}_QA_PIXEL"], self.qa_lut, mask_filters = [("opening", 4),("dilation", 6)])
 
             for b in ls_bands:
                 if b != f"{self.sensor}_QA_PIXEL":
-                    if self.sensor.endswith("st"):
+                    if self.sensor.endswith("st") or b.endswith("_lwir"):
                         stack[b] = (0.00341802 * stack[b] + 149.0).astype("float32")
                     else:
                         stack[b] = (2.75e-05 * stack[b] - 0.2).astype("float32")
             
             
 
-            if self.cloud_mask:
-                cloud_mask = stack[f"{self.sensor}_mask"].groupby("time.date").max("time").rename({"date": "time"})
-
-            stack = stack.groupby("time.date").median("time").rename({"date": "time"})
+            stack = mosaic(stack, "last", groups = "date")
 
             if self.cloud_mask:
-                stack[f"{self.sensor}_mask"] = cloud_mask
-                stack[f"{self.sensor}_mask"].attrs = {"provider": f"Landsat {self.sensor[2]} {self.sensor[4:].upper()}", "interpolation_type": "nearest", "description": "Data mask", "classes": """
+                stack[f"{self.sensor}_mask"].attrs = {"provider": self.provider_name, "interpolation_type": "nearest", "description": "Data mask", "classes": """
                 0 - Valid
                 1 - Invalid
                 """}
 
 
+            descriptions = self.DESCRIPTIONS_COMMON if self.multi_sensor else self.DESCRIPTIONS_BY_SENSOR[self.sensor]
             for b in self.bands:
-                bandname = f"{self.sensor}_{b.split('_')[1] if b!= 'QA_PIXEL' else b}"
+                bandname = self.band_name(b)
                 if bandname in ls_bands:
-                    stack[bandname].attrs = {"provider": f"Landsat {self.sensor[2]} {self.sensor[4:].upper()}", "interpolation_type": "linear" if b != f"{self.sensor}_QA_PIXEL" else "nearest", "description": self.DESCRIPTIONS_BY_SENSOR[self.sensor][b]}
+                    stack[bandname].attrs = {"provider": self.provider_name, "interpolation_type": "linear" if b != "QA_PIXEL" else "nearest", "description": descriptions[b]}
 
 
             if self.drop_qa:
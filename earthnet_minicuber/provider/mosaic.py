@@ -0,0 +1,86 @@
+
+import numpy as np
+import xarray as xr
+
+
+def group_labels(data, groups = None, dim = "time"):
+    """Label of each step along dim: the values of groups (an array, or a datetime component like "date" of dim), or a single group if groups is None."""
+    if groups is None:
+        return np.zeros(data.sizes[dim], dtype = int)
+    if isinstance(groups, str):
+        return data[f"{dim}.{groups}"].values
+    return np.asarray(groups)
+
+
+def validity(data, dim = "time", nodata = None, variables = None):
+    """Valid pixels of data along dim and the two spatial (last) dims: all variables in variables (default: all with dim and spatial dims), and all entries along any other dim (e.g. band), are not NaN (or not nodata for integer variables).
+
+    Variables (or entries) that are invalid everywhere in a step, e.g. bands a sensor does not have, are ignored for that step. A pixel needs at least one valid variable.
+    """
+    if isinstance(data, xr.DataArray):
+        arrays = [data]
+    else:
+        arrays = [data[v] for v in (variables if variables is not None else data.data_vars) if (dim in data[v].dims) and (data[v].ndim >= 3)]
+
+    valid, present = None, None
+    for v in arrays:
+        ok = v.notnull() if (nodata is None) or not np.issubdtype(v.dtype, np.integer) else (v != nodata)
+        other = [d for d in v.dims if d not in [dim, *v.dims[-2:]]]
+        ok_all = (ok | ~ok.any(v.dims[-2:])).all(other)
+        ok_any = ok.any(other)
+        valid = ok_all if valid is None else (valid & ok_all)
+        present = ok_any if present is None else (present | ok_any)
+    return valid & present
+
+
+def mosaic(data, mode = "last", groups = None, priority = None, valid = None, nodata = None, variables = None, dim = "time"):
+    """Mosaics all steps of data along dim that share a group label into one, pixel by pixel.
+
+    Per pixel, the first valid step (mode "first"), the last valid step (mode "last") or the valid step with the lowest priority value (mode "priority", ties in order along dim) is taken, the same step for all variables. Pixels without any valid step keep the preferred step. Validity is given by valid (a boolean array along dim and the spatial dims) or derived from variables and nodata (see validity). groups is an array of labels or a datetime component of dim (e.g. "date"); the result is indexed by the sorted unique labels. With groups = None all steps are mosaicked and dim is dropped.
+
+    The members of each group are ranked once on the labels; the data is then gathered level by level (preferred step, first fallback, ...) and merged with elementwise where, so dask stacks stay chunked and are never sorted or regrouped.
+    """
+    labels = group_labels(data, groups = groups, dim = dim)
+    unique, inverse = np.unique(labels, return_inverse = True)
+    inverse = inverse.ravel()
+
+    position = np.arange(len(labels))
+    if mode == "first":
+        preference = position
+    elif mode == "last":
+        preference = -position
+    elif mode == "priority":
+        preference = np.asarray(priority)
+    else:
+        raise ValueError(f"Unknown mosaic mode {mode}, use one of first, last, priority")
+
+    order = np.lexsort((position, preference, inverse))
+    counts = np.bincount(inverse, minlength = len(unique))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    def level(arr, k):
+        step = arr.isel({dim: order[starts + np.minimum(k, counts - 1)]})
+        step = step.drop_vars([c for c in step.coords if (dim in step[c].dims) and (c != dim)])
+        return step.assign_coords({dim: unique})
+
+    out = level(data, 0)
+
+    if counts.max() > 1:
+        if valid is None:
+            valid = validity(data, dim = dim, nodata = nodata, variables = variables)
+        done = level(valid, 0)
+        for k in range(1, counts.max()):
+            fill = xr.DataArray(counts > k, coords = {dim: unique}, dims = (dim,)) & ~done & level(valid, k)
+            step = level(data, k)
+            if isinstance(out, xr.DataArray):
+                out = out.where(~fill, step)
+            else:
+                for v in out.data_vars:
+                    if set(fill.dims) <= set(out[v].dims):
+                        out[v] = out[v].where(~fill, step[v])
+            done = done | fill
+
+    if groups is None:
+        out = out.isel({dim: 0}, drop = True)
+
+    return out
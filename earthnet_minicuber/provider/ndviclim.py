@@ -7,7 +7,7 @@ import xarray as xr
 import numpy as np
 from rasterio import RasterioIOError
 
-from . import provider_base
+from . import provider_base, stac_utils
 
 
 class NDVIClim(provider_base.Provider):
@@ -20,19 +20,27 @@ class NDVIClim(provider_base.Provider):
         URL = "https://explorer.digitalearth.africa/stac/"
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items)
+
         os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
         os.environ['AWS_S3_ENDPOINT'] = 's3.af-south-1.amazonaws.com'
 
 
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, ["ndvi_climatology_ls"], name = "NDVIClim")
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, None)
+
     def load_data(self, bbox, time_interval, **kwargs):
 
         gdal_session = stackstac.DEFAULT_GDAL_ENV.updated(always=dict(session=rasterio.session.AWSSession(aws_unsigned = True, endpoint_url = 's3.af-south-1.amazonaws.com')))
         
         with rasterio.Env(aws_unsigned = True, AWS_S3_ENDPOINT= 's3.af-south-1.amazonaws.com'):
-            items_clim = self.catalog.search(
-                bbox = bbox,
-                collections=["ndvi_climatology_ls"],
-            ).get_all_items()
+            items_clim = self.planner.get_items(bbox, None)
+
+            if items_clim is None:
+                return None
 
             if len(items_clim.to_dict()['features']) == 0:
                 return None
@@ -40,7 +48,10 @@ class NDVIClim(provider_base.Provider):
             metadata = items_clim.to_dict()['features'][0]["properties"]
             epsg = metadata["proj:epsg"]
 
-            stack = stackstac.stack(items_clim, epsg = epsg, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 800,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session)
+            assets = [f"{'stddev' if b == 'std' else b}_{m}" for b in self.bands for m in ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']]
+
+            stack = stac_utils.stack(items_clim, epsg, bbox, assets = assets, nearest_assets = [a for a in assets if a.startswith("count")], resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 800,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session)
+            epsg = stack.attrs["epsg"]
 
             clims = {}
             if "mean" in self.bands:
@@ -1,10 +1,18 @@
-
 from abc import abstractmethod, ABC
 
 class Provider(ABC):
 
+    # Sequential providers keep state across the intervals of a minicube (e.g. a multi-temporal filter), so their intervals are loaded one after another in time order.
+    is_sequential = False
+
     @abstractmethod
     def load_data(self, bbox, time_interval, **kwargs):
         pass
 
-    
\ No newline at end of file
+    def plan(self, bbox, time_interval, **kwargs):
+        """Called once per minicube with the full bbox and time interval before any call to load_data. Does nothing by default."""
+        pass
+
+    def item_selection(self, bbox, time_interval, **kwargs):
+        """Returns the ids of the items intersecting bbox and of the items among them load_data reads for bbox (as two frozensets), or None if load_data reads all of them. Minicuber.load_shared only shares a read between minicubes whose selections agree. None by default."""
+        return None
@@ -1,3 +1,7 @@
+import io
+import tempfile
+import threading
+from pathlib import Path
 
 import numpy as np
 import segmentation_models_pytorch as smp 
@@ -7,50 +11,182 @@ import torch
 
 from torch.utils.model_zoo import load_url
 
-def get_checkpoint(bands_avail):
+from .nbar import harmonize
+
+CHECKPOINTS = {
+    "mobilenetv2_l2a_all": ("https://nextcloud.bgc-jena.mpg.de/s/qHKcyZpzHtXnzL2/download/mobilenetv2_l2a_all.pth", ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12', 'AOT', 'WVP']),
+    "mobilenetv2_l2a_rgbnir": ("https://nextcloud.bgc-jena.mpg.de/s/Ti4aYdHe2m3jBHy/download/mobilenetv2_l2a_rgbnir.pth", ["B02", "B03", "B04", "B8A"])
+}
+
+def select_checkpoint(bands_avail):
 
     bands_avail = set(bands_avail)
 
-    if set(['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12', 'AOT', 'WVP']).issubset(bands_avail):
-        ckpt = load_url("https://nextcloud.bgc-jena.mpg.de/s/qHKcyZpzHtXnzL2/download/mobilenetv2_l2a_all.pth")
-        ckpt_bands = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12', 'AOT', 'WVP']
-    elif set(["B02", "B03", "B04", "B8A"]).issubset(bands_avail):
-        ckpt = load_url("https://nextcloud.bgc-jena.mpg.de/s/Ti4aYdHe2m3jBHy/download/mobilenetv2_l2a_rgbnir.pth")
-        ckpt_bands = ["B02", "B03", "B04", "B8A"]
+    for name, (url, ckpt_bands) in CHECKPOINTS.items():
+        if set(ckpt_bands).issubset(bands_avail):
+            return name, ckpt_bands
+
+    raise Exception(f"The bands {bands_avail} do not contain the necessary bands for cloud masking. Please include at least bands B02, B03, B04 and B8A.")
+
+def get_checkpoint(bands_avail, checkpoint_path = None):
+    """Returns the state dict and bands of the best checkpoint for bands_avail.
+
+    If checkpoint_path is given, the weights are loaded from there without network access: either the .pth file itself, or a directory containing the checkpoint under its original file name (e.g. mobilenetv2_l2a_rgbnir.pth).
+    """
+
+    name, ckpt_bands = select_checkpoint(bands_avail)
+
+    if checkpoint_path is None:
+        ckpt = load_url(CHECKPOINTS[name][0])
     else:
-        raise Exception(f"The bands {bands_avail} do not contain the necessary bands for cloud masking. Please include at least bands B02, B03, B04 and B8A.")
-        ckpt = None
-        ckpt_bands = None
+        checkpoint_path = Path(checkpoint_path)
+        if checkpoint_path.is_dir():
+            checkpoint_path = checkpoint_path/f"{name}.pth"
+        ckpt = torch.load(checkpoint_path, map_location = "cpu")
 
     return ckpt, ckpt_bands
 
 
+class OnnxModel:
+    """Wraps an ONNX Runtime session of the U-Net, so it can be called like the torch model."""
+
+    def __init__(self, model, in_channels, quantize = False, num_threads = None):
+        import onnxruntime
+
+        f = io.BytesIO()
+        torch.onnx.export(model, torch.zeros(1, in_channels, 128, 128), f, input_names = ["x"], output_names = ["y"], dynamic_axes = {"x": {0: "batch", 2: "height", 3: "width"}, "y": {0: "batch", 2: "height", 3: "width"}}, opset_version = 17, dynamo = False)
+        onnx_model = f.getvalue()
+
+        if quantize:
+            import onnx
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            from onnxruntime.quantization.preprocess import quant_pre_process
+
+            # quantize_dynamic only works on files.
+            with tempfile.TemporaryDirectory() as tmpdir:
+                onnx.save(onnx.load_from_string(onnx_model), f"{tmpdir}/model.onnx")
+                quant_pre_process(f"{tmpdir}/model.onnx", f"{tmpdir}/model_pre.onnx", skip_symbolic_shape = True)
+                quantize_dynamic(f"{tmpdir}/model_pre.onnx", f"{tmpdir}/model_int8.onnx", weight_type = QuantType.QUInt8)
+                with open(f"{tmpdir}/model_int8.onnx", "rb") as fq:
+                    onnx_model = fq.read()
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_model, options, providers = ["CPUExecutionProvider"])
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {"x": x.numpy()})[0])
+
+
+ENGINES = ["torch", "torchscript", "onnx"]
+
+MODEL_CACHE = {}
+MODEL_CACHE_LOCK = threading.Lock()
+
+def load_model(bands, engine = "torch", quantize = False, checkpoint_path = None, num_threads = None):
+    """Returns the cloud mask model for bands and its input bands, built once per process and configuration.
+
+    engine is "torch" (eager PyTorch), "torchscript" (traced and frozen) or "onnx" (ONNX Runtime, optionally with dynamic int8 quantization of the weights).
+    """
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown cloud mask engine {engine}, choose one of {ENGINES}.")
+    if quantize and (engine != "onnx"):
+        raise ValueError("Int8 quantization of the cloud mask is only supported with engine = 'onnx'.")
+
+    name, ckpt_bands = select_checkpoint(bands)
+    key = (name, engine, quantize, str(checkpoint_path), num_threads if engine == "onnx" else None)
+
+    with MODEL_CACHE_LOCK:
+        if key not in MODEL_CACHE:
+
+            ckpt, ckpt_bands = get_checkpoint(bands, checkpoint_path = checkpoint_path)
+
+            model = smp.Unet(
+                    encoder_name="mobilenet_v2",
+                    encoder_weights=None,
+                    classes=4,
+                    in_channels=len(ckpt_bands)       
+            )
+
+            if ckpt:
+                model.load_state_dict(ckpt)
+
+            model.eval()
+
+            if engine == "torchscript":
+                with torch.no_grad():
+                    model = torch.jit.freeze(torch.jit.trace(model, torch.zeros(1, len(ckpt_bands), 128, 128)))
+            elif engine == "onnx":
+                model = OnnxModel(model, len(ckpt_bands), quantize = quantize, num_threads = num_threads)
+
+            MODEL_CACHE[key] = model
+
+        return MODEL_CACHE[key], ckpt_bands
+
+
+def tile_windows(size, tile_size, tile_overlap):
+    """Returns (start, stop, lo, hi) per tile along one axis: the tile covers start:stop, its prediction is kept for lo:hi. Neighbouring tiles overlap by tile_overlap pixels, of which each keeps half, so every kept pixel has context on both sides."""
+
+    if (tile_size is None) or (size <= tile_size):
+        return [(0, size, 0, size)]
+
+    step = tile_size - tile_overlap
+    starts = list(range(0, size - tile_size, step)) + [size - tile_size]
+
+    return [(start, start + tile_size, 0 if start == 0 else start + tile_overlap//2, size if start + tile_size == size else start + tile_size - tile_overlap//2) for start in starts]
+
+
 class CloudMask:
-    def __init__(self, bands = ["B02", "B03", "B04", "B8A"], cloud_mask_rescale_factor = None):
+    """U-Net cloud mask for Sentinel 2.
+
+    Inference runs on batches of batch_size time steps. Scenes larger than tile_size pixels are split into tiles overlapping by tile_overlap pixels, which are stitched by keeping the central part of each tile. num_threads sets the number of intra-op threads. See load_model for engine, quantize and checkpoint_path; models are shared by all CloudMask instances of a process.
+
+    If stack has a baseline_offset coordinate, the model input is harmonized to the processing baseline (see nbar.processing_baseline_offsets).
+
+    Time steps with a valid pixel fraction (see valid_fraction) of at most min_valid_fraction, e.g. outside the swath or fully no data, are masked as 4 without inference.
+
+    Called on a dask-backed stack, the mask is computed lazily with xarray.map_blocks over chunks of batch_size time steps. CloudMask instances can be pickled to dask workers, which reload the model from the process-wide cache.
+    """
+
+    def __init__(self, bands = ["B02", "B03", "B04", "B8A"], cloud_mask_rescale_factor = None, batch_size = 8, tile_size = 512, tile_overlap = 64, num_threads = None, engine = "torch", quantize = False, checkpoint_path = None, min_valid_fraction = 0.0):
+
+        if (tile_size is not None) and not (0 <= tile_overlap < tile_size):
+            raise ValueError(f"tile_overlap must be at least 0 and smaller than tile_size, got tile_overlap = {tile_overlap} and tile_size = {tile_size}.")
 
         self.cloud_mask_rescale_factor = cloud_mask_rescale_factor
         self.bands = bands
-        ckpt, self.ckpt_bands = get_checkpoint(bands)
+        self.batch_size = batch_size
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.min_valid_fraction = min_valid_fraction
+        self.num_threads = num_threads
+        self.engine = engine
+        self.quantize = quantize
+        self.checkpoint_path = checkpoint_path
 
-        self.model = smp.Unet(
-                encoder_name="mobilenet_v2",
-                encoder_weights=None,
-                classes=4,
-                in_channels=len(self.ckpt_bands)       
-        )
+        self.load_model()
 
-        if ckpt:
-            self.model.load_state_dict(ckpt)
+        self.bands_scale = xr.DataArray(12*[10000,] + [65535, 65535, 1], coords = {"band": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "AOT", "WVP", "SCL"]})
 
-        self.model.eval()
+    def load_model(self):
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
 
-        self.bands_scale = xr.DataArray(12*[10000,] + [65535, 65535, 1], coords = {"band": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "AOT", "WVP", "SCL"]})
+        self.model, self.ckpt_bands = load_model(self.bands, engine = self.engine, quantize = self.quantize, checkpoint_path = self.checkpoint_path, num_threads = self.num_threads)
 
-    def __call__(self, stack):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["model"]
+        return state
 
-        ds = stack.to_dataset("band")
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_model()
 
-        x = torch.from_numpy((stack.sel(band = self.ckpt_bands)/self.bands_scale).fillna(1.0).transpose("time", "band", "y", "x").values.astype("float32"))
+    def predict_tile(self, x):
+        """Predicts the mask classes of a (batch, band, y, x) tensor."""
 
         b, c, h, w = x.shape
 
@@ -76,11 +212,67 @@ class CloudMask:
         if self.cloud_mask_rescale_factor:
             y_hat = torch.nn.functional.max_pool2d(y_hat[:,None,...], kernel_size = self.cloud_mask_rescale_factor)[:,0,...]#torch.nn.functional.interpolate(y_hat, size = orig_size, mode = "bilinear")
                                                 
-        y_hat = y_hat[:, h_pad_left:-h_pad_right, w_pad_left:-w_pad_right]
+        return y_hat[:, h_pad_left:h_pad_left+h, w_pad_left:w_pad_left+w]
+
+    def predict(self, x):
+        """Predicts the cloud mask of a (time, band, y, x) float32 array in batches along time and overlapping tiles in space. Returns a (time, y, x) float32 array."""
+
+        t, c, h, w = x.shape
+
+        y_windows = tile_windows(h, self.tile_size, self.tile_overlap)
+        x_windows = tile_windows(w, self.tile_size, self.tile_overlap)
+
+        mask = np.empty((t, h, w), dtype = "float32")
+
+        for i in range(0, t, self.batch_size or t):
+            batch = torch.from_numpy(x[i:i + (self.batch_size or t)])
+            for y_start, y_stop, y_lo, y_hi in y_windows:
+                for x_start, x_stop, x_lo, x_hi in x_windows:
+                    y_hat = self.predict_tile(batch[:, :, y_start:y_stop, x_start:x_stop]).cpu().numpy()
+                    mask[i:i + len(batch), y_lo:y_hi, x_lo:x_hi] = y_hat[:, y_lo - y_start:y_hi - y_start, x_lo - x_start:x_hi - x_start]
+
+        return mask
+
+    def valid_fraction(self, stack):
+        """Fraction of valid pixels per time step: all model bands are finite and non-zero and SCL is neither no data (0) nor saturated / defective (1)."""
+
+        bands = stack.sel(band = self.ckpt_bands)
+        valid = (bands.notnull() & (bands != 0)).all("band")
+
+        if "SCL" in stack.band:
+            valid = valid & stack.sel(band = "SCL").notnull() & ~stack.sel(band = "SCL").isin([0, 1])
+
+        return valid.mean(("y", "x")).values
+
+    def __call__(self, stack):
+
+        if stack.chunks is not None:
+            stack = stack.chunk({"time": self.batch_size or -1, "band": -1, "y": -1, "x": -1})
+            template = xr.concat([stack, stack.isel(band = [0]).assign_coords(band = ["mask"])], dim = "band").chunk({"band": -1})
+            return xr.map_blocks(self, stack, template = template)
+
+        dims = stack.dims
+
+        ds = stack.to_dataset("band")
+
+        # Time steps without enough valid pixels are masked (4 - masked other reasons) without running the model.
+        run = self.valid_fraction(stack) > self.min_valid_fraction
+
+        mask = np.full((len(stack.time), len(stack.y), len(stack.x)), 4, dtype = stack.dtype if stack.dtype.kind in "ui" else "float32")
+
+        if run.any():
+            x = stack.isel(time = run).sel(band = self.ckpt_bands).transpose("time", "band", "y", "x")
+            offsets = x.baseline_offset.values if "baseline_offset" in x.coords else None
+            x = x.values.astype("float32", copy = True)
+            if offsets is not None:
+                harmonize(x, self.ckpt_bands, offsets)
+            x /= self.bands_scale.sel(band = self.ckpt_bands).values.astype("float32")[None, :, None, None]
+            x[np.isnan(x)] = 1.0
+            mask[run] = self.predict(x)
 
-        ds["mask"] = (("time", "y", "x"),y_hat.cpu().numpy())
+        ds["mask"] = (("time", "y", "x"), mask)
 
-        return ds.to_array("band")
+        return ds.to_array("band").transpose(*dims)
     
 def cloud_mask_reduce(x, axis = None, **kwargs):
     return np.where((x==1).any(axis = axis), 1, np.where((x==3).any(axis = axis), 3, np.where((x==2).any(axis = axis), 2, np.where((x==0).any(axis = axis), 0, 4))))
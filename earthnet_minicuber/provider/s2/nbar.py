@@ -1,83 +1,147 @@
 
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import xarray as xr
 
 from sen2nbar.c_factor import c_factor_from_item
 
-def correct_processing_baseline(stack, items):
+from ...regrid import get_regridder
+
+REFLECTANCE_BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12"]
+
+def processing_baseline_offsets(stack, items):
     """
     Adapted from https://github.com/ESDS-Leipzig/sen2nbar/blob/main/sen2nbar/nbar.py#L105 
+
+    Returns the DN offset of every time step of stack: after processing baseline 04.00 all DN values are shifted by 1000.
     """
     items_dict = {item.id: item for item in items}
-    ordered_items = [items_dict[itemid] for itemid in stack.id.values]
-    processing_baseline = []
-    for item in ordered_items:
-        processing_baseline.append(item.properties["s2:processing_baseline"])
-    
-    # Processing baseline as data array
-    processing_baseline = xr.DataArray(
-        [float(x) for x in processing_baseline],
-        dims="time",
-        coords=dict(time=stack.time.values),
-    )
+    return np.array([-1000 if float(items_dict[itemid].properties["s2:processing_baseline"]) >= 4.0 else 0 for itemid in stack.id.values], dtype = "float32")
 
-    # Whether to shift the DN values
-    # After 04.00 all DN values are shifted by 1000
-    harmonize = xr.where(processing_baseline >= 4.0, -1000, 0)
 
-    orig_bands = stack.band.values.tolist()
+def harmonize(data, bands, offsets):
+    """Sets zero (no data) reflectances of a (time, band, y, x) float32 array to NaN and shifts them by the processing baseline offsets, in place."""
+    for j, band in enumerate(bands):
+        if band in REFLECTANCE_BANDS:
+            for t in range(data.shape[0]):
+                v = data[t, j]
+                v[~(v > 0)] = np.nan
+                if offsets[t] != 0:
+                    v += offsets[t]
+    return data
 
-    stack_to_harmonize = stack.to_dataset("band")[[v for v in orig_bands if v in ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12"]]].to_array("band")
 
-    stack_rest = stack.to_dataset("band")[[v for v in orig_bands if v not in stack_to_harmonize.band]]
+NBAR_BANDS = ['B02','B03','B04','B05','B06','B07','B08','B11','B12']
 
-    # Zeros are NaN
-    stack_to_harmonize = stack_to_harmonize.where(lambda x: x > 0, other=np.nan)
+C_FACTOR_CACHE = OrderedDict()
+C_FACTOR_CACHE_SIZE = 1024
+C_FACTOR_CACHE_LOCK = threading.Lock()
 
-    # Harmonize (use processing baseline)
-    stack_harmonized = stack_to_harmonize + harmonize
-    
-    stack = xr.merge([stack_harmonized.to_dataset("band"), stack_rest])[orig_bands].to_array("band")
+def get_c_factor(item, epsg):
+    """Returns the c-factor of an item on its native (coarse) grid as a float32 DataArray (band, y, x), or None if it cannot be computed. Results are cached (LRU) per (item id, epsg)."""
 
-    return stack
+    key = (item.id, epsg)
+    with C_FACTOR_CACHE_LOCK:
+        if key in C_FACTOR_CACHE:
+            C_FACTOR_CACHE.move_to_end(key)
+            return C_FACTOR_CACHE[key]
 
+    try:
+        c = c_factor_from_item(item, f"epsg:{epsg}").astype("float32").compute()
+    except ValueError:
+        c = None
 
-def call_sen2nbar(stack, items, epsg):
-    """
-    Adapted from https://github.com/ESDS-Leipzig/sen2nbar/blob/main/sen2nbar/nbar.py#L105 
+    with C_FACTOR_CACHE_LOCK:
+        C_FACTOR_CACHE[key] = c
+        while len(C_FACTOR_CACHE) > C_FACTOR_CACHE_SIZE:
+            C_FACTOR_CACHE.popitem(last = False)
+
+    return c
+
+
+def c_factor_array(stack, items, epsg, bands, n_threads = 8):
+    """Returns the c-factors of bands for every time step of stack as a (time, band, y, x) float32 array.
+
+    The c-factors of all items are computed on a thread pool (or taken from the cache) and interpolated linearly, with extrapolation, onto the x/y grid of stack with a precomputed regridder. Items without a c-factor get NaN.
     """
 
     items_dict = {item.id: item for item in items}
-    ordered_items = [items_dict[itemid] for itemid in stack.id.values]
+    item_ids = list(dict.fromkeys(stack.id.values))
+
+    with ThreadPoolExecutor(max_workers = n_threads) as executor:
+        c_factors = dict(zip(item_ids, executor.map(lambda itemid: get_c_factor(items_dict[itemid], epsg), item_ids)))
+
+    x, y = stack.x.values, stack.y.values
+
+    c_array = np.full((len(stack.time), len(bands), len(y), len(x)), np.nan, dtype = "float32")
+    for itemid, c in c_factors.items():
+        if c is None:
+            continue
+        regridder = get_regridder(c.x.values, c.y.values, x, y, method = "linear", extrapolate = True)
+        c_array[stack.id.values == itemid] = regridder(c.sel(band = bands).drop_vars(["x", "y"])).transpose("band", "y", "x").values
+
+    return c_array
+
+
+def radiometric_correction(stack, items, epsg, brdf_correction = True, n_threads = 8):
+    """Converts Sentinel 2 DNs to (NBAR) reflectances in a single float32 pass.
+
+    If stack has a baseline_offset coordinate (see processing_baseline_offsets), zero reflectances become NaN and are shifted by the offset. With brdf_correction, the NBAR c-factors (adapted from https://github.com/ESDS-Leipzig/sen2nbar/blob/main/sen2nbar/nbar.py#L105) are applied. Reflectances are divided by 10000, AOT and WVP by 65535. All steps run per time step and band on one copy of the data; dask-backed stacks are processed block by block.
+
+    Integer (compact) stacks stay integer: 0 marks no data, the baseline shift and c-factors are applied in integer space (clipped to 1..65535 for valid pixels) and the scaling is left to the scale_factor metadata.
+    """
+
+    stack = stack.transpose("time", "band", "y", "x")
+
+    if stack.chunks is not None:
+        return xr.map_blocks(radiometric_correction, stack, args = [items, epsg], kwargs = {"brdf_correction": brdf_correction, "n_threads": n_threads}, template = stack if stack.dtype.kind in "ui" else stack.astype("float32"))
+
+    bands = stack.band.values.tolist()
+
+    nbar_bands = [b for b in bands if b in NBAR_BANDS] if brdf_correction else []
+    c = c_factor_array(stack, items, epsg, nbar_bands, n_threads = n_threads) if len(nbar_bands) > 0 else None
+
+    offsets = stack.baseline_offset.values if "baseline_offset" in stack.coords else None
+
+    if stack.dtype.kind in "ui":
+        return stack.copy(data = radiometric_kernel_int(stack.values.copy(), bands, offsets, c, nbar_bands))
+
+    divisors = [65535 if b in ["AOT", "WVP"] else (None if b in ["SCL", "mask"] else 10000) for b in bands]
+
+    data = stack.values.astype("float32", copy = True)
 
-    # Compute the c-factor per item and extract the processing baseline
-    c_array = []
-    for item in ordered_items:#tqdm(ordered_items, disable=quiet):
-        try:
-            c = c_factor_from_item(item, f"epsg:{epsg}")
-            c = c.interp(
-                y=stack.y.values,
-                x=stack.x.values,
-                method="linear",
-                kwargs={"fill_value": "extrapolate"},
-            )
-        except ValueError:
-            c = xr.DataArray(np.full((9,len(stack.y), len(stack.x)), np.NaN), coords = {"band": ['B02','B03','B04','B05','B06','B07','B08','B11','B12'], "y": stack.y, "x": stack.x}, dims = ("band", "y", "x"))
-        c_array.append(c)
+    if offsets is not None:
+        harmonize(data, bands, offsets)
 
-    orig_bands = stack.band.values.tolist()
+    for j, band in enumerate(bands):
+        for t in range(data.shape[0]):
+            v = data[t, j]
+            if band in nbar_bands:
+                v *= c[t, nbar_bands.index(band)]
+            if divisors[j] is not None:
+                v /= divisors[j]
 
-    # Concatenate c-factor
-    c = xr.concat(c_array, dim="time")
-    c["time"] = stack.time.values
+    return stack.copy(data = data)
 
-    stack_to_nbar = stack.to_dataset("band")[[v for v in c.to_dataset("band").data_vars.keys() if v in stack.band]].to_array("band")
 
-    stack_rest = stack.to_dataset("band")[[v for v in stack.to_dataset("band").data_vars.keys() if v not in stack_to_nbar.band]]
+def radiometric_kernel_int(data, bands, offsets = None, c = None, nbar_bands = []):
+    """Integer counterpart of radiometric_correction on a (time, band, y, x) unsigned integer array with 0 as no data, in place."""
 
-    # Compute NBAR
-    stack_nbar = stack_to_nbar * c
+    vmax = np.iinfo(data.dtype).max
 
-    stack_out = xr.merge([stack_nbar.to_dataset("band"), stack_rest])[orig_bands].to_array("band")
+    for j, band in enumerate(bands):
+        for t in range(data.shape[0]):
+            v = data[t, j]
+            if (offsets is not None) and (band in REFLECTANCE_BANDS) and (offsets[t] < 0):
+                shift = int(-offsets[t])
+                v[(v > 0) & (v <= shift)] = shift + 1
+                v[v > 0] -= shift
+            if band in nbar_bands:
+                nbar = np.rint(v * c[t, nbar_bands.index(band)])
+                # Pixels without a c-factor become no data, like the NaNs of the float path.
+                v[...] = np.where((v > 0) & np.isfinite(nbar), np.clip(nbar, 1, vmax), 0)
 
-    return stack_out
\ No newline at end of file
+    return data
@@ -4,19 +4,15 @@ import pystac_client
 import stackstac
 import rasterio
 
-import planetary_computer as pc
 from rasterio import RasterioIOError
-import time
 import numpy as np
 import xarray as xr
-import random
 from contextlib import nullcontext
 
-from shapely.geometry import Polygon, box
-
-from .nbar import call_sen2nbar, correct_processing_baseline
+from .nbar import processing_baseline_offsets, radiometric_correction
 from .cloudmask import CloudMask, cloud_mask_reduce
-from .. import provider_base
+from .. import provider_base, stac_utils
+from ..mosaic import mosaic
 
 S2BANDS_DESCRIPTION = {
     "B01": "Coastal aerosol",
@@ -39,11 +35,11 @@ S2BANDS_DESCRIPTION = {
 
 class Sentinel2(provider_base.Provider):
 
-    def __init__(self, bands = ["AOT", "B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "WVP"], best_orbit_filter = True, five_daily_filter = False, brdf_correction = True, cloud_mask = True, cloud_mask_rescale_factor = None, aws_bucket = "planetary_computer", s2_avail_var = True, correct_processing_baseline = True):
+    def __init__(self, bands = ["AOT", "B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "WVP"], best_orbit_filter = True, five_daily_filter = False, brdf_correction = True, cloud_mask = True, cloud_mask_rescale_factor = None, cloud_mask_kwargs = None, aws_bucket = "planetary_computer", s2_avail_var = True, correct_processing_baseline = True, max_cloud_cover = None, min_coverage = None, compact = False):
         
         self.is_temporal = True
 
-        self.cloud_mask = CloudMask(bands=bands, cloud_mask_rescale_factor = cloud_mask_rescale_factor) if cloud_mask else None
+        self.cloud_mask = CloudMask(bands=bands, cloud_mask_rescale_factor = cloud_mask_rescale_factor, **(cloud_mask_kwargs if cloud_mask_kwargs is not None else {})) if cloud_mask else None
 
         if self.cloud_mask and "SCL" not in bands:
             bands += ["SCL"]
@@ -55,6 +51,9 @@ class Sentinel2(provider_base.Provider):
         self.aws_bucket = aws_bucket
         self.s2_avail_var = s2_avail_var
         self.correct_processing_baseline = correct_processing_baseline
+        self.max_cloud_cover = max_cloud_cover
+        self.min_coverage = min_coverage
+        self.compact = compact
 
         if aws_bucket == "dea":
             URL = "https://explorer.digitalearth.africa/stac/"
@@ -69,6 +68,10 @@ class Sentinel2(provider_base.Provider):
                 del os.environ['AWS_S3_ENDPOINT']
         
         self.catalog = pystac_client.Client.open(URL)
+        self.collection = "s2_l2a" if self.aws_bucket == "dea" else ("sentinel-2-l2a" if self.aws_bucket == "planetary_computer" else "sentinel-s2-l2a-cogs")
+
+        self.planner = stac_utils.ItemPlanner(self.search_items, sign = (self.aws_bucket == "planetary_computer"))
+        self.best_orbit_dates_cache = {}
 
         os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
 
@@ -80,6 +83,10 @@ class Sentinel2(provider_base.Provider):
         attrs["description"] = S2BANDS_DESCRIPTION[band]
         if self.brdf_correction and band in ["B02", "B03", "B04", "B05", "B06", "B07", "B08", "B11", "B12"]:
             attrs["brdf_correction"] = "Nadir BRDF Adjusted Reflectance (NBAR)"
+        if self.compact and band not in ["SCL", "mask", "avail"]:
+            attrs["scale_factor"] = 1/65535 if band in ["AOT", "WVP"] else 1/10000
+            attrs["add_offset"] = 0.0
+            attrs["_FillValue"] = 0
         if band == "SCL":
             attrs["classes"] = """
                             0 - No data
@@ -108,6 +115,77 @@ class Sentinel2(provider_base.Provider):
         
 
 
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, [self.collection], datetime = time_interval, name = "Sen2")
+
+    def plan(self, bbox, time_interval, **kwargs):
+        full_time_interval = kwargs.get("full_time_interval", time_interval)
+        if self.best_orbit_filter:
+            time_interval = stac_utils.join_time_intervals(time_interval, full_time_interval)
+        self.planner.plan(bbox, time_interval)
+
+    def get_best_orbit_dates(self, bbox, full_time_interval):
+
+        key = (tuple(bbox), full_time_interval)
+        if key not in self.best_orbit_dates_cache:
+
+            items_s2_best_orbit = self.planner.get_items(bbox, full_time_interval)
+
+            if (items_s2_best_orbit is None) or (len(items_s2_best_orbit) == 0):
+                return None
+
+            coverage = stac_utils.footprint_coverage(items_s2_best_orbit, bbox)
+            max_area_date = stac_utils.item_dates(items_s2_best_orbit)[np.argmax(coverage)]
+            min_date, max_date = np.datetime64(full_time_interval[:10]), np.datetime64(full_time_interval[-10:])
+
+            self.best_orbit_dates_cache[key] = np.arange(max_area_date - ((max_area_date - min_date)//5)*5, max_date+1, 5)
+
+        return self.best_orbit_dates_cache[key]
+
+    def filter_items(self, items, bbox, time_interval, **kwargs):
+        """Drops items before stacking: acquisitions off the best orbit or five-daily date grid, with eo:cloud_cover above max_cloud_cover, or covering less than min_coverage of the bbox."""
+
+        if len(items) == 0:
+            return items
+
+        keep = np.ones(len(items), dtype = bool)
+
+        if self.best_orbit_filter or self.five_daily_filter:
+
+            full_time_interval = kwargs.get("full_time_interval", time_interval)
+
+            if self.best_orbit_filter:
+                dates = self.get_best_orbit_dates(bbox, full_time_interval)
+                if dates is None:
+                    return None
+            else:
+                min_date, max_date = np.datetime64(full_time_interval[:10]), np.datetime64(full_time_interval[-10:])
+                dates = np.arange(min_date, max_date+1, 5)
+
+            keep &= np.isin(stac_utils.item_dates(items), dates)
+
+        if self.max_cloud_cover is not None:
+            keep &= np.array([item.properties.get("eo:cloud_cover", 0.0) <= self.max_cloud_cover for item in items])
+
+        if self.min_coverage is not None:
+            keep &= stac_utils.footprint_coverage(items, bbox) >= self.min_coverage
+
+        return stac_utils.select_items(items, keep)
+
+    def item_selection(self, bbox, time_interval, **kwargs):
+        """See Provider.item_selection. Only the best orbit and min_coverage filters depend on the bbox, without them None is returned."""
+
+        if not (self.best_orbit_filter or (self.min_coverage is not None)):
+            return None
+
+        items = self.planner.get_items(bbox, time_interval)
+        if items is None:
+            return frozenset(), frozenset()
+
+        selected = self.filter_items(items, bbox, time_interval, **kwargs)
+
+        return frozenset(item.id for item in items), frozenset(item.id for item in (selected or []))
+
     def load_data(self, bbox, time_interval, **kwargs):
 
         if self.aws_bucket == "dea":
@@ -119,37 +197,30 @@ class Sentinel2(provider_base.Provider):
         gdal_session = stackstac.DEFAULT_GDAL_ENV.updated(always=dict(session=rasterio.session.AWSSession(aws_unsigned = True, endpoint_url = 's3.af-south-1.amazonaws.com' if self.aws_bucket == "dea" else None)))
 
         with cm as gs:
-        
 
-            search = self.catalog.search(
-                        bbox = bbox,
-                        collections=["s2_l2a" if self.aws_bucket == "dea" else ("sentinel-2-l2a" if self.aws_bucket == "planetary_computer" else "sentinel-s2-l2a-cogs")],
-                        datetime=time_interval
-                    )
-            
-            if self.aws_bucket == "planetary_computer":
-                for attempt in range(10):
-                    try:
-                        items_s2 = pc.sign(search)
-                    except pystac_client.exceptions.APIError:
-                        print(f"Sen2: Planetary computer time out, attempt {attempt}, retrying in 60 seconds...")
-                        time.sleep(random.uniform(30,90))
-                    else:
-                        break
-                else:
-                    print("Loading Sen2 failed after 10 attempts...")
-                    return None
+            items_s2 = self.planner.get_items(bbox, time_interval)
+
+            if items_s2 is None:
+                return None
+
+            # With item_ids (see item_selection), the items were already filtered for each minicube of a shared read.
+            if kwargs.get("item_ids") is not None:
+                items_s2 = stac_utils.select_items(items_s2, [item.id in kwargs["item_ids"] for item in items_s2])
             else:
-                items_s2 = search.get_all_items()
+                items_s2 = self.filter_items(items_s2, bbox, time_interval, **kwargs)
 
-            if len(items_s2.to_dict()['features']) == 0:
+            if (items_s2 is None) or (len(items_s2) == 0):
                 return None
 
             metadata = items_s2.to_dict()['features'][0]["properties"]
             epsg = metadata["proj:epsg"]
 
 
-            stack = stackstac.stack(items_s2, epsg = epsg, assets = self.bands, dtype = "float32", properties = ["sentinel:product_id"], band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 2048,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session)
+            # In compact mode, DNs stay uint16 with 0 as no data; scale_factor, add_offset and _FillValue are only set as attrs.
+            dtype_kwargs = {"dtype": "uint16", "fill_value": 0, "rescale": False} if self.compact else {"dtype": "float32"}
+
+            stack = stac_utils.stack(items_s2, epsg, bbox, assets = self.bands, nearest_assets = ["SCL"], resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), properties = ["sentinel:product_id"], band_coords = False, xy_coords = 'center', chunksize = 2048,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session, **dtype_kwargs)
+            epsg = stack.attrs["epsg"]
 
 
             if self.aws_bucket != "planetary_computer":
@@ -159,72 +230,20 @@ class Sentinel2(provider_base.Provider):
 
             stack.attrs["epsg"] = epsg
 
-            if self.best_orbit_filter:
-                
-                if "full_time_interval" in kwargs:
-                    full_time_interval = kwargs["full_time_interval"]
-
-                    search_best_orbit = self.catalog.search(
-                            bbox = bbox,
-                            collections=["s2_l2a" if self.aws_bucket == "dea" else ("sentinel-2-l2a" if self.aws_bucket == "planetary_computer" else "sentinel-s2-l2a-cogs")],
-                            datetime=full_time_interval
-                        )
-
-                    if self.aws_bucket == "planetary_computer":
-                        items_s2_best_orbit = pc.sign(search_best_orbit)
-                    else:
-                        items_s2_best_orbit = search_best_orbit.get_all_items()
-                else:
-                    full_time_interval = time_interval
-                    items_s2_best_orbit = items_s2
-
-                bbox_poly = box(*bbox)
-                area_and_dates = [(bbox_poly.intersection(Polygon(f['geometry']["coordinates"][0])).area, np.datetime64(f["properties"]["datetime"][:10])) for f in items_s2_best_orbit.to_dict()['features']]
-
-                _, max_area_date = max(area_and_dates, key = lambda x: x[0])
-                min_date, max_date = np.datetime64(full_time_interval[:10]), np.datetime64(full_time_interval[-10:])
-
-                dates = np.arange(max_area_date - ((max_area_date - min_date)//5)*5, max_date+1, 5)
-
-                stack = stack.sel(time = stack.time.dt.date.isin(dates))
-            
-            elif self.five_daily_filter:
-
-                if "full_time_interval" in kwargs:
-                    full_time_interval = kwargs["full_time_interval"]
-                else:
-                    full_time_interval = time_interval
-
-                min_date, max_date = np.datetime64(full_time_interval[:10]), np.datetime64(full_time_interval[-10:])
-
-                dates = np.arange(min_date, max_date+1, 5)
-
-                stack = stack.sel(time = stack.time.dt.date.isin(dates))
-
-            if len(stack.time) == 0:
-                return None
-
             if self.correct_processing_baseline:
-                stack = correct_processing_baseline(stack, items_s2)
+                stack = stack.assign_coords(baseline_offset = ("time", processing_baseline_offsets(stack, items_s2)))
 
             if self.cloud_mask:
-                stack = self.cloud_mask(stack.compute())
+                stack = self.cloud_mask(stack)
 
-            if self.brdf_correction:
-                stack = call_sen2nbar(stack, items_s2, epsg)
+            stack = radiometric_correction(stack, items_s2, epsg, brdf_correction = self.brdf_correction)
                     
             bands = stack.band.values
             stack["band"] = [f"s2_{b}" for b in stack.band.values]
 
             stack = stack.to_dataset("band")
 
-            for band in bands:
-                if band in ["AOT", "WVP"]:
-                    stack[f"s2_{band}"] = (stack[f"s2_{band}"]/65535).astype("float32")
-                elif band not in ["SCL","mask"]:
-                    stack[f"s2_{band}"] = (stack[f"s2_{band}"]/10000).astype("float32")
-            
-            stack = stack.drop_vars(["epsg", "id", "id_old", "sentinel:data_coverage", "sentinel:sequence", "sentinel:product_id"], errors = "ignore")
+            stack = stack.drop_vars(["epsg", "id", "baseline_offset", "id_old", "sentinel:data_coverage", "sentinel:sequence", "sentinel:product_id"], errors = "ignore")
             
             stack["time"] = np.array([str(d) for d in stack.time.values], dtype="datetime64[D]")
 
@@ -232,7 +251,7 @@ class Sentinel2(provider_base.Provider):
                 stack["s2_avail"] = xr.DataArray(np.ones_like(stack.time.values, dtype = "uint8"), coords = {"time": stack.time.values}, dims = ("time",))
             
             if len(stack.time) > 0:
-                stack = stack.groupby("time.date").last(skipna = False).rename({"date": "time"})
+                stack = mosaic(stack, "last", groups = "date", nodata = 0 if self.compact else None, variables = [f"s2_{b}" for b in bands if b != "mask"])
             else:
                 return None
             
@@ -1,6 +1,7 @@
 
 
 import os
+import warnings
 import pystac_client
 import stackstac
 import rasterio
@@ -8,38 +9,136 @@ import numpy as np
 import xarray as xr
 from rasterio import RasterioIOError
 from contextlib import nullcontext
-import time
-import random
-import planetary_computer as pc
 
 
-from scipy.ndimage.filters import uniform_filter
-from scipy.ndimage.measurements import variance
+from scipy.ndimage import uniform_filter
+import dask.array
 
-from . import provider_base
+from . import provider_base, stac_utils
+from .mosaic import mosaic
+
+
+def lee_slice(img, overall_variance, size):
+    """Lee filter of the 2D float32 array img, ignoring NaNs (which stay NaN)."""
+    valid = np.isfinite(img)
+    all_valid = valid.all()
+    x = img if all_valid else np.where(valid, img, 0).astype("float32")
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        img_mean = uniform_filter(x, size)
+        img_sqr_mean = uniform_filter(x * x, size)
+        if not all_valid:
+            count = uniform_filter(valid.astype("float32"), size)
+            img_mean /= count
+            img_sqr_mean /= count
+        img_variance = np.maximum(img_sqr_mean - img_mean**2, 0)
+        img_weights = img_variance / (img_variance + overall_variance)
+        img_output = img_mean + img_weights * (x - img_mean)
+
+    if not all_valid:
+        img_output[~valid] = np.nan
+    return img_output
+
+
+def slice_variance(img):
+    """Variance of every 2D slice of img (over its last two axes), ignoring NaNs, with the last two axes kept."""
+    flat = img.reshape(-1, *img.shape[-2:])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.array([np.nanvar(v, dtype = "float64") for v in flat], dtype = "float32").reshape(img.shape[:-2] + (1, 1))
+
+
+def lee_kernel(img, overall_variance, size):
+    """Lee filter of every 2D slice (last two axes) of the float32 array img. overall_variance broadcasts against img and holds the variance of each slice."""
+    out = np.empty(img.shape, dtype = "float32")
+    overall_variance = np.broadcast_to(overall_variance, img.shape[:-2] + (1, 1))
+    for idx in np.ndindex(img.shape[:-2]):
+        out[idx] = lee_slice(img[idx], overall_variance[idx], size)
+    return out
 
 
 def lee_filter(da, size):
     """
-    Apply lee filter of specified window size.
+    Apply lee filter of specified window size to every 2D (y, x) slice of da, ignoring NaNs.
     Adapted from https://stackoverflow.com/questions/39785970/speckle-lee-filter-in-python
     and from https://docs.digitalearthafrica.org/fr/latest/sandbox/notebooks/Real_world_examples/Radar_water_detection.html
 
+    All slices (e.g. times and polarizations) are filtered in one float32 call. Dask-backed arrays stay lazy and are filtered blockwise with a halo of size // 2 pixels.
     """
-    img = da.values
-    img_mean = uniform_filter(img, (size, size))
-    img_sqr_mean = uniform_filter(img**2, (size, size))
-    img_variance = img_sqr_mean - img_mean**2
+    da = da.transpose(..., "y", "x").astype("float32")
 
-    overall_variance = variance(img)
+    if da.chunks is None:
+        return da.copy(data = lee_kernel(da.values, slice_variance(da.values), size))
 
-    img_weights = img_variance / (img_variance + overall_variance)
-    img_output = img_mean + img_weights * (img - img_mean)
+    overall_variance = dask.array.nanvar(da.data, axis = (-2, -1), dtype = "float64", keepdims = True).astype("float32")
 
-    return img_output
+    halo = {da.ndim - 2: size // 2, da.ndim - 1: size // 2}
+    data = dask.array.map_overlap(lee_kernel, da.data, overall_variance, depth = [halo, {}], boundary = "none", dtype = "float32", size = size)
+
+    return da.copy(data = data)
 
 FILTERS = {"lee": lee_filter}
 
+
+def local_mean(img, size):
+    """Mean over size x size windows of every 2D slice (last two axes) of the float32 array img, ignoring NaNs."""
+    out = np.empty(img.shape, dtype = "float32")
+    for idx in np.ndindex(img.shape[:-2]):
+        valid = np.isfinite(img[idx])
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            out[idx] = uniform_filter(np.where(valid, img[idx], 0).astype("float32"), size) / uniform_filter(valid.astype("float32"), size)
+    return out
+
+
+class QueganFilter:
+    """
+    Streaming multi-temporal speckle filter after Quegan & Yu (2001): J_k = E[I_k] / n * sum_i I_i / E[I_i], with E the local mean over size x size windows.
+    Adapted from https://doi.org/10.1109/36.964971
+
+    The running sums of I_i / E[I_i] and the number of valid dates n are kept per pixel across calls, so the filter is causal: each date uses itself and all dates filtered before it. Calls must therefore come in time order (see Provider.is_sequential) and memory is bounded by one call plus the running sums. The state is reset by reset() and whenever the grid or polarizations change.
+
+    With few dates the estimate is barely filtered (J_1 = I_1), so pixels with fewer than min_looks valid dates are Lee filtered (see lee_filter) instead.
+    """
+
+    def __init__(self, size = 9, min_looks = 4):
+        self.size = size
+        self.min_looks = min_looks
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.ratio_sum = None
+        self.count = None
+
+    def __call__(self, da):
+        da = da.transpose(..., "time", "y", "x").astype("float32")
+        img = da.values
+
+        key = (tuple(tuple(da[d].values.tolist()) for d in da.dims[:-3]), da.x.values[[0, -1]].tolist(), da.y.values[[0, -1]].tolist(), img.shape[-2:])
+        if key != self.key:
+            self.key = key
+            self.ratio_sum = np.zeros(img.shape[:-3] + img.shape[-2:], dtype = "float32")
+            self.count = np.zeros(img.shape[:-3] + img.shape[-2:], dtype = "float32")
+
+        img_mean = local_mean(img, self.size)
+
+        out = np.empty(img.shape, dtype = "float32")
+        for t in np.argsort(da.time.values, kind = "stable"):
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                ratio = img[..., t, :, :] / img_mean[..., t, :, :]
+            valid = np.isfinite(ratio)
+            self.ratio_sum += np.where(valid, ratio, 0)
+            self.count += valid
+            filtered = img_mean[..., t, :, :] * self.ratio_sum / np.maximum(self.count, 1)
+            few_looks = self.count < self.min_looks
+            if (valid & few_looks).any():
+                filtered = np.where(few_looks, lee_kernel(img[..., t, :, :], slice_variance(img[..., t, :, :]), self.size), filtered)
+            out[..., t, :, :] = np.where(valid, filtered, np.nan)
+
+        return da.copy(data = out)
+
+TEMPORAL_FILTERS = {"quegan": QueganFilter}
+
 def get_valid_trafo_s1(item):
     a,b,c,d,e,f,g,h,j = item.properties["proj:transform"]
     if c == 0 and e == 0:
@@ -58,6 +157,13 @@ class Sentinel1(provider_base.Provider):
         self.bands = bands
         self.speckle_filter = speckle_filter
         self.speckle_filter_kwargs = speckle_filter_kwargs
+
+        # Multi-temporal filters keep running statistics across intervals, so these must be loaded in time order.
+        if speckle_filter and (speckle_filter_kwargs["type"] in TEMPORAL_FILTERS):
+            self.temporal_filter = TEMPORAL_FILTERS[speckle_filter_kwargs["type"]](**{k: v for k, v in speckle_filter_kwargs.items() if k != "type"})
+        else:
+            self.temporal_filter = None
+        self.is_sequential = self.temporal_filter is not None
         self.s1_avail_var = s1_avail_var
         self.aws_bucket = aws_bucket
 
@@ -67,11 +173,31 @@ class Sentinel1(provider_base.Provider):
             URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items, sign = (self.aws_bucket == "planetary_computer"))
+
         if self.aws_bucket == "dea":
             os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
             os.environ['AWS_S3_ENDPOINT'] = 's3.af-south-1.amazonaws.com'
 
 
+    def search_items(self, bbox, time_interval):
+
+        items_s1 = stac_utils.search_items(self.catalog, bbox, ["s1_rtc" if self.aws_bucket == "dea" else "sentinel-1-rtc"], datetime = time_interval, name = "Sen1")
+
+        if (items_s1 is not None) and (self.aws_bucket == "dea"):
+            for item in items_s1:
+                trafo = get_valid_trafo_s1(item)
+                item.properties["proj:transform"] = trafo
+                for asset in item.assets:
+                    item.assets[asset].extra_fields['proj:transform'] = trafo
+
+        return items_s1
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, time_interval)
+        if self.temporal_filter is not None:
+            self.temporal_filter.reset()
+
     def load_data(self, bbox, time_interval, **kwargs):
 
         gdal_session = stackstac.DEFAULT_GDAL_ENV.updated(always=dict(session=rasterio.session.AWSSession(aws_unsigned = True, endpoint_url = 's3.af-south-1.amazonaws.com' if self.aws_bucket == "dea" else None)))
@@ -84,32 +210,10 @@ class Sentinel1(provider_base.Provider):
         
         with cm as gs:
 
-            search = self.catalog.search(
-                    bbox = bbox,
-                    collections=["s1_rtc" if self.aws_bucket == "dea" else "sentinel-1-rtc"],
-                    datetime=time_interval
-                )
-                
-            if self.aws_bucket == "planetary_computer":
-                for attempt in range(10):
-                    try:
-                        items_s1 = pc.sign(search)
-                    except pystac_client.exceptions.APIError:
-                        print(f"Sen2: Planetary computer time out, attempt {attempt}, retrying in 60 seconds...")
-                        time.sleep(random.uniform(30,90))
-                    else:
-                        break
-                else:
-                    print("Loading Sen2 failed after 10 attempts...")
-                    return None
-            else:
-                items_s1 = search.get_all_items()
+            items_s1 = self.planner.get_items(bbox, time_interval)
 
-                for item in items_s1:
-                    trafo = get_valid_trafo_s1(item)
-                    item.properties["proj:transform"] = trafo
-                    for asset in item.assets:
-                        item.assets[asset].extra_fields['proj:transform'] = trafo
+            if items_s1 is None:
+                return None
                 
             if len(items_s1.to_dict()['features']) == 0:
                 return None
@@ -118,7 +222,8 @@ class Sentinel1(provider_base.Provider):
             epsg = metadata["proj:epsg"]
             # geotransform = metadata["proj:transform"]
 
-            stack = stackstac.stack(items_s1, epsg = epsg, assets = self.bands, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 2048,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session)
+            stack = stac_utils.stack(items_s1, epsg, bbox, assets = self.bands, nearest_assets = ["mask"], resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 2048,errors_as_nodata=(RasterioIOError('.*'), ), gdal_env=gdal_session)
+            epsg = stack.attrs["epsg"]
 
             # stack = stack.isel(time = [v[0] for v in stack.groupby("time.date").groups.values()])
 
@@ -126,17 +231,14 @@ class Sentinel1(provider_base.Provider):
 
             stack = stack.to_dataset("band")
 
-            if self.speckle_filter:
-                valid = np.isfinite(stack)
-                #stack = stack.where(valid, 0)
-
-                if "s1_vv" in stack.variables:
-                    stack["s1_vv"] = stack.where(valid, 0).s1_vv.groupby("time").apply(FILTERS[self.speckle_filter_kwargs["type"]], size=self.speckle_filter_kwargs["size"])
-                    stack['s1_vv'] = stack.s1_vv.where(valid.s1_vv)
-
-                if "s1_vh" in stack.variables:
-                    stack["s1_vh"] = stack.where(valid, 0).s1_vh.groupby("time").apply(FILTERS[self.speckle_filter_kwargs["type"]], size=self.speckle_filter_kwargs["size"])
-                    stack['s1_vh'] = stack.s1_vh.where(valid.s1_vh)
+            pols = [v for v in ["s1_vv", "s1_vh"] if v in stack.data_vars]
+            if self.speckle_filter and (len(pols) > 0):
+                if self.temporal_filter is not None:
+                    filtered = self.temporal_filter(stack[pols].to_array("pol"))
+                else:
+                    filtered = FILTERS[self.speckle_filter_kwargs["type"]](stack[pols].to_array("pol"), size=self.speckle_filter_kwargs["size"])
+                for v in pols:
+                    stack[v] = filtered.sel(pol = v, drop = True)
             
             
             
@@ -146,7 +248,7 @@ class Sentinel1(provider_base.Provider):
                 stack = stack.rename({"x": "lon", "y": "lat"})
             
             if len(stack.time) > 0:
-                stack = stack.groupby("time.date").last(skipna = False).rename({"date": "time"})
+                stack = mosaic(stack, "last", groups = "date")
             else:
                 return None
 
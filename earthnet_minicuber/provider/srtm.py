@@ -1,13 +1,13 @@
 
 import os
 import pystac_client
-import stackstac
 import rasterio
 import xarray as xr
 import numpy as np
 
 
-from . import provider_base
+from . import provider_base, stac_utils
+from .mosaic import mosaic
 
 
 class SRTM(provider_base.Provider):
@@ -22,10 +22,18 @@ class SRTM(provider_base.Provider):
         URL = "https://explorer.digitalearth.africa/stac/"
         self.catalog = pystac_client.Client.open(URL)
 
+        self.planner = stac_utils.ItemPlanner(self.search_items)
+
         os.environ['AWS_NO_SIGN_REQUEST'] = "TRUE"
         os.environ['AWS_S3_ENDPOINT'] = 's3.af-south-1.amazonaws.com'
 
 
+    def search_items(self, bbox, time_interval):
+        return stac_utils.search_items(self.catalog, bbox, ["dem_srtm"], name = "SRTM")
+
+    def plan(self, bbox, time_interval, **kwargs):
+        self.planner.plan(bbox, None)
+
     def load_data(self, bbox, time_interval, **kwargs):
         
         with rasterio.Env(aws_unsigned = True, AWS_S3_ENDPOINT= 's3.af-south-1.amazonaws.com'):
@@ -33,10 +41,10 @@ class SRTM(provider_base.Provider):
             stack = None
 
             # if "dem" in self.bands:
-            items_srtm = self.catalog.search(
-                    bbox = bbox,
-                    collections=["dem_srtm"]
-                ).get_all_items()
+            items_srtm = self.planner.get_items(bbox, None)
+
+            if items_srtm is None:
+                return None
 
             if len(items_srtm.to_dict()['features']) == 0:
                 return None
@@ -44,7 +52,8 @@ class SRTM(provider_base.Provider):
             metadata = items_srtm.to_dict()['features'][0]["properties"]
             epsg = metadata["proj:epsg"]
 
-            stack = stackstac.stack(items_srtm, epsg = epsg, dtype = "float32", properties = False, band_coords = False, bounds_latlon = bbox, xy_coords = 'center', chunksize = 512)
+            stack = stac_utils.stack(items_srtm, epsg, bbox, resolution = kwargs.get("resolution"), grid = kwargs.get("grid"), dtype = "float32", properties = False, band_coords = False, xy_coords = 'center', chunksize = 512)
+            epsg = stack.attrs["epsg"]
             stack["band"] = ["dem"]
 
             # if "mrrtf" in self.bands or "mrvbf" in self.bands or "slope" in self.bands:
@@ -64,7 +73,7 @@ class SRTM(provider_base.Provider):
 
             # stack = stack.sel(band = self.bands)
 
-            stack = stack.median("time")
+            stack = mosaic(stack, "first")
 
             stack["band"] = [f"srtm_{b}" for b in stack.band.values]
 
@@ -0,0 +1,325 @@
+
+import time
+import random
+import numpy as np
+import shapely
+import shapely.geometry
+import pyproj
+import xarray as xr
+import stackstac
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.errors import RasterioIOError
+import pystac
+import pystac_client
+import requests
+import planetary_computer as pc
+
+from .item_cache import get_item_cache
+
+# OverviewReader builds on stackstac internals (written against stackstac 0.5), without them data is read at native resolution.
+try:
+    from stackstac.rio_reader import AutoParallelRioReader, SelfCleaningDatasetReader, ThreadLocalRioDataset, SingleThreadedRioDataset, MULTITHREADED_DRIVER_ALLOWLIST
+except ImportError:
+    AutoParallelRioReader = None
+
+
+def search_items(catalog, bbox, collections, datetime = None, sign = False, name = "STAC"):
+    """Runs a catalog search and returns all found items.
+
+    If the item cache is enabled (see item_cache.set_item_cache), results are served from and stored in the cache. If sign is True, the items are signed for the Planetary Computer, also on a cache hit. Returns None if the search fails after 10 attempts.
+    """
+
+    cache = get_item_cache()
+    if cache is not None:
+        key = cache.make_key(catalog.get_self_href(), collections, bbox, datetime)
+        items = cache.get(key)
+    else:
+        items = None
+
+    search_kwargs = {"bbox": bbox, "collections": collections}
+    if datetime is not None:
+        search_kwargs["datetime"] = datetime
+
+    for attempt in range(10):
+        try:
+            if items is None:
+                items = catalog.search(**search_kwargs).get_all_items()
+                if cache is not None:
+                    cache.put(key, items)
+            signed_items = pc.sign(items) if sign else items
+        except pystac_client.exceptions.APIError:
+            print(f"{name}: STAC API time out, attempt {attempt}, retrying in 60 seconds...")
+            time.sleep(random.uniform(30,90))
+        else:
+            break
+    else:
+        print(f"Loading {name} failed after 10 attempts...")
+        return None
+
+    return signed_items
+
+
+def sign_items(items):
+    for attempt in range(10):
+        try:
+            return pc.sign(items)
+        except requests.exceptions.RequestException:
+            print(f"Planetary computer signing failed, attempt {attempt}, retrying in 60 seconds...")
+            time.sleep(random.uniform(30,90))
+    print("Signing items failed after 10 attempts...")
+    return None
+
+
+def join_time_intervals(*time_intervals):
+    start = min(t[:10] for t in time_intervals)
+    end = max(t[-10:] for t in time_intervals)
+    return f"{start}/{end}"
+
+
+def bbox_contains(outer, inner):
+    return (outer[0] <= inner[0]) and (outer[1] <= inner[1]) and (outer[2] >= inner[2]) and (outer[3] >= inner[3])
+
+
+def bbox_intersects(a, b):
+    return (a[0] <= b[2]) and (a[2] >= b[0]) and (a[1] <= b[3]) and (a[3] >= b[1])
+
+
+def filter_items(items, time_interval = None, bbox = None):
+    """Returns the items acquired within time_interval (dates inclusive) whose bbox intersects bbox."""
+
+    start, end = (time_interval[:10], time_interval[-10:]) if time_interval is not None else (None, None)
+
+    filtered = []
+    for item in items:
+        if time_interval is not None:
+            date = (item.datetime or item.common_metadata.start_datetime).strftime("%Y-%m-%d")
+            if (date < start) or (date > end):
+                continue
+        if (bbox is not None) and (item.bbox is not None) and not bbox_intersects(item.bbox, bbox):
+            continue
+        filtered.append(item)
+
+    return pystac.ItemCollection(filtered)
+
+
+def item_dates(items):
+    """Acquisition dates of items as a datetime64[D] array."""
+    return np.array([(item.datetime or item.common_metadata.start_datetime).strftime("%Y-%m-%d") for item in items], dtype = "datetime64[D]")
+
+
+def footprint_coverage(items, bbox):
+    """Fraction of bbox (in lon/lat) covered by the footprint of each item, computed with vectorized shapely operations."""
+    footprints = np.array([shapely.geometry.shape(item.geometry) for item in items])
+    bbox_poly = shapely.box(*bbox)
+    return shapely.area(shapely.intersection(footprints, bbox_poly)) / bbox_poly.area
+
+
+def select_items(items, keep):
+    return pystac.ItemCollection([item for item, k in zip(items, keep) if k])
+
+
+def native_resolutions(items, assets = None):
+    """Finest pixel size of each asset key of items (all if assets is None), in units of their CRS, read from proj:transform. Assets without projection metadata are left out."""
+    sizes = {}
+    for item in items:
+        for key, asset in item.assets.items():
+            if (assets is not None) and (key not in assets):
+                continue
+            transform = asset.extra_fields.get("proj:transform", item.properties.get("proj:transform"))
+            if transform is not None:
+                sizes[key] = min([sizes.get(key, np.inf), abs(transform[0]), abs(transform[4])])
+    return sizes
+
+
+def native_resolution(items, assets = None):
+    """Finest pixel size of the assets of items (all if assets is None), in units of their CRS. None if the items carry no projection metadata."""
+    sizes = native_resolutions(items, assets)
+    return min(sizes.values()) if len(sizes) > 0 else None
+
+
+def overview_level(factor):
+    """Overview level of a COG with the usual overview factors 2, 4, 8, ... that is the coarsest one at most factor times coarser than native resolution. None if factor < 2."""
+    if (factor is None) or (factor < 2):
+        return None
+    return min(int(np.log2(factor * (1 + 1e-6))) - 1, 15)
+
+
+if AutoParallelRioReader is not None:
+
+    class OverviewReader(AutoParallelRioReader):
+        """stackstac reader that opens each asset at overview level (see overview_reader), so GDAL reads the overview instead of every native pixel.
+
+        The WarpedVRT that stackstac builds on top of the full resolution dataset does not use overviews. Usually, each asset is opened once. Only if that overview does not exist or is coarser than the output grid (e.g. for overview factors other than powers of 2), the overviews are looked up on the full resolution dataset first.
+        """
+
+        level = None
+
+        def target_resolutions(self, ds):
+            resolutions = self.spec.resolutions_xy
+            geographic = pyproj.CRS.from_epsg(self.spec.epsg).is_geographic
+            if geographic != ds.crs.is_geographic:
+                resolutions = [r * 111320 if geographic else r / 111320 for r in resolutions]
+            return resolutions
+
+        def open_level(self, level):
+            with self.gdal_env.open:
+                try:
+                    ds = SelfCleaningDatasetReader(self.url, sharing = False, OVERVIEW_LEVEL = level)
+                except RasterioIOError:
+                    return None
+            if (ds.count == 1) and all(n <= r * (1 + 1e-6) for r, n in zip(self.target_resolutions(ds), ds.res)):
+                return ds
+            ds.close()
+            return None
+
+        def best_level(self):
+            with self.gdal_env.open:
+                try:
+                    with rasterio.open(self.url, sharing = False) as ds:
+                        factor = min(r / n for r, n in zip(self.target_resolutions(ds), ds.res))
+                        overviews = ds.overviews(1)
+                except RasterioIOError:
+                    return None
+            levels = [i for i, f in enumerate(overviews) if f <= factor * (1 + 1e-6)]
+            return levels[-1] if len(levels) > 0 else None
+
+        def _open(self):
+            ds = self.open_level(self.level)
+            if ds is None:
+                level = self.best_level()
+                ds = self.open_level(level) if level is not None else None
+            if ds is None:
+                return super()._open()
+
+            with self.gdal_env.open_vrt:
+                vrt = WarpedVRT(ds, sharing = False, resampling = self.resampling, add_alpha = ds.nodata is None, **self.spec.vrt_params)
+
+            if ds.driver in MULTITHREADED_DRIVER_ALLOWLIST:
+                return ThreadLocalRioDataset(self.gdal_env, ds, vrt = vrt)
+            return SingleThreadedRioDataset(self.gdal_env, ds, vrt = vrt)
+
+    # One module level subclass per level, so dask can pickle them.
+    for _level in range(16):
+        globals()[f"OverviewReader{_level}"] = type(f"OverviewReader{_level}", (OverviewReader,), {"level": _level, "__module__": __name__})
+    del _level
+
+
+def overview_reader(factor):
+    """stackstac reader for data read factor times coarser than native, None (stackstac default) if no overview is coarse enough or stackstac internals are unavailable."""
+    level = overview_level(factor)
+    if (level is None) or (AutoParallelRioReader is None):
+        return None
+    return globals()[f"OverviewReader{level}"]
+
+
+def resolution_kwargs(items, epsg, resolution, assets = None, min_factor = 2):
+    """Keyword arguments for stackstac.stack that read at the target resolution (in metres) if it is at least min_factor times coarser than the native resolution of items. Otherwise returns {} and data is read at native resolution.
+
+    For geographic CRS, the target resolution is converted to degrees of latitude.
+    """
+    if resolution is None:
+        return {}
+    native = native_resolution(items, assets)
+    if native is None:
+        return {}
+    if pyproj.CRS.from_epsg(epsg).is_geographic:
+        resolution = resolution / 111320
+    if resolution < min_factor * native:
+        return {}
+    return {"resolution": resolution}
+
+
+def grid_kwargs(grid):
+    """Keyword arguments for stackstac.stack that read directly onto grid, the (lon, lat) pixel centres of a regular EPSG:4326 grid."""
+    lon, lat = grid
+    dx, dy = abs(lon[1] - lon[0]), abs(lat[1] - lat[0])
+    return {"epsg": 4326, "bounds": (min(lon) - dx / 2, min(lat) - dy / 2, max(lon) + dx / 2, max(lat) + dy / 2), "resolution": (dx, dy), "snap_bounds": False}
+
+
+def reader_groups(items, assets, resolution, geographic):
+    """Splits assets (all if None) into groups read with the same overview reader at resolution (in degrees if geographic, else metres). Returns a list of (assets, reader) pairs."""
+    if resolution is None:
+        return [(assets, None)]
+    natives = native_resolutions(items, assets)
+    if len(natives) == 0:
+        return [(assets, None)]
+    item_epsg = items[0].properties.get("proj:epsg")
+    if (item_epsg is not None) and (pyproj.CRS.from_epsg(item_epsg).is_geographic != geographic):
+        resolution = resolution * 111320 if geographic else resolution / 111320
+    if assets is None:
+        return [(None, overview_reader(resolution / min(natives.values())))]
+    readers = {a: overview_reader(resolution / natives[a]) if a in natives else None for a in assets}
+    return [([a for a in assets if readers[a] is reader], reader) for reader in dict.fromkeys(readers.values())]
+
+
+def stack(items, epsg, bbox, assets = None, nearest_assets = (), resampling = "bilinear", resolution = None, grid = None, **kwargs):
+    """stackstac.stack of the assets of items within bbox, in the CRS epsg at native resolution (or coarser, see resolution_kwargs).
+
+    If grid is given, the data is instead warped directly onto this (lon, lat) grid while reading (see grid_kwargs): assets in nearest_assets are resampled with nearest neighbour, all others with resampling. Data read coarser than native comes from the COG overviews (see OverviewReader). The EPSG code of the returned stack is stored in its attrs.
+    """
+
+    if grid is None:
+        read_kwargs = {"epsg": epsg, "bounds_latlon": bbox, **resolution_kwargs(items, epsg, resolution, assets = assets)}
+        groups = [(assets, {})]
+        geographic = pyproj.CRS.from_epsg(epsg).is_geographic
+        target = read_kwargs.get("resolution")
+    else:
+        read_kwargs = grid_kwargs(grid)
+        if (assets is None) or (len(nearest_assets) == 0):
+            groups = [(assets, {"resampling": Resampling[resampling]})]
+        else:
+            groups = [([a for a in assets if a not in nearest_assets], {"resampling": Resampling[resampling]}), ([a for a in assets if a in nearest_assets], {"resampling": Resampling.nearest})]
+        geographic = True
+        target = min(read_kwargs["resolution"])
+
+    data = []
+    for group, method_kwargs in groups:
+        if (group is not None) and (len(group) == 0):
+            continue
+        for subgroup, reader in reader_groups(items, group, target, geographic):
+            data.append(stackstac.stack(items, **({} if subgroup is None else {"assets": subgroup}), **({} if reader is None else {"reader": reader}), **method_kwargs, **read_kwargs, **kwargs))
+
+    data = data[0] if len(data) == 1 else xr.concat(data, dim = "band").sel(band = assets)
+    data.attrs["epsg"] = epsg if grid is None else 4326
+    return data
+
+
+class ItemPlanner:
+    """Runs one catalog search over the whole extent of a minicube (or a cluster of minicubes) and hands out the items for each monthly interval.
+
+    search_fn(bbox, time_interval) must return an unsigned item collection or None. For static collections, time_interval is None. If sign is True, items are signed for the Planetary Computer when they are handed out, so long-running plans do not serve expired tokens.
+    """
+
+    def __init__(self, search_fn, sign = False):
+        self.search_fn = search_fn
+        self.sign = sign
+        self.bbox = None
+        self.time_interval = None
+        self.items = None
+
+    def covers(self, bbox, time_interval):
+        if (self.items is None) or not bbox_contains(self.bbox, bbox):
+            return False
+        if (self.time_interval is None) or (time_interval is None):
+            return self.time_interval == time_interval
+        return (self.time_interval[:10] <= time_interval[:10]) and (self.time_interval[-10:] >= time_interval[-10:])
+
+    def plan(self, bbox, time_interval):
+        if self.covers(bbox, time_interval):
+            return
+        items = self.search_fn(bbox, time_interval)
+        if items is not None:
+            self.bbox, self.time_interval, self.items = tuple(bbox), time_interval, items
+
+    def get_items(self, bbox, time_interval):
+        if self.covers(bbox, time_interval):
+            items = filter_items(self.items, time_interval, None if tuple(bbox) == self.bbox else bbox)
+        else:
+            items = self.search_fn(bbox, time_interval)
+
+        if (items is not None) and self.sign:
+            items = sign_items(items)
+
+        return items
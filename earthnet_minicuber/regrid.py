@@ -0,0 +1,147 @@
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+
+
+def axis_weights(src, dst, method = "linear", extrapolate = False):
+    """Computes source indices and weights to interpolate along one axis from the coordinates src onto dst.
+
+    Returns (i0, i1, w, valid) such that the interpolated values are (1 - w) * v[i0] + w * v[i1], and valid marks targets inside the source range.
+    """
+
+    src = np.asarray(src, dtype = "float64")
+    dst = np.asarray(dst, dtype = "float64")
+    n = len(src)
+
+    descending = (n > 1) and (src[-1] < src[0])
+    s = src[::-1] if descending else src
+
+    if n == 1:
+        i0 = i1 = np.zeros(len(dst), dtype = "int64")
+        w = np.zeros(len(dst), dtype = "float32")
+    elif method == "nearest":
+        idx = np.clip(np.searchsorted(s, dst), 1, n - 1)
+        i0 = i1 = np.where((dst - s[idx - 1]) <= (s[idx] - dst), idx - 1, idx)
+        w = np.zeros(len(dst), dtype = "float32")
+    else:
+        i0 = np.clip(np.searchsorted(s, dst, side = "right") - 1, 0, n - 2)
+        i1 = i0 + 1
+        w = ((dst - s[i0]) / (s[i1] - s[i0])).astype("float32")
+
+    if extrapolate:
+        valid = np.ones(len(dst), dtype = bool)
+    else:
+        valid = (dst >= s[0]) & (dst <= s[-1])
+
+    if descending:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+
+    return i0, i1, w, valid
+
+
+class Regridder:
+    """Precomputed separable regridder from one rectilinear grid onto another.
+
+    Holds nearest-neighbour indices or bilinear weights per axis, which are applied to all variables and time steps of a dataset with a single gather per axis.
+    """
+
+    def __init__(self, src_x, src_y, dst_x, dst_y, method = "linear", extrapolate = False):
+        self.method = method
+        self.x_i0, self.x_i1, self.x_w, self.x_valid = axis_weights(src_x, dst_x, method = method, extrapolate = extrapolate)
+        self.y_i0, self.y_i1, self.y_w, self.y_valid = axis_weights(src_y, dst_y, method = method, extrapolate = extrapolate)
+        self.all_valid = self.x_valid.all() and self.y_valid.all()
+
+    def __call__(self, ds, xdim = "x", ydim = "y"):
+
+        if self.method == "nearest":
+            out = ds.isel({ydim: self.y_i0, xdim: self.x_i0})
+        else:
+            wy = xr.DataArray(self.y_w, dims = (ydim,))
+            wx = xr.DataArray(self.x_w, dims = (xdim,))
+            out = ds.isel({ydim: self.y_i0}) * (1 - wy) + ds.isel({ydim: self.y_i1}) * wy
+            out = out.isel({xdim: self.x_i0}) * (1 - wx) + out.isel({xdim: self.x_i1}) * wx
+
+        if not self.all_valid:
+            out = out.where(xr.DataArray(self.y_valid, dims = (ydim,)) & xr.DataArray(self.x_valid, dims = (xdim,)))
+
+        return out
+
+
+REGRIDDER_CACHE = OrderedDict()
+REGRIDDER_CACHE_SIZE = 128
+REGRIDDER_CACHE_LOCK = threading.Lock()
+
+def get_regridder(src_x, src_y, dst_x, dst_y, method = "linear", extrapolate = False):
+    """Returns a Regridder for the given grids and method, reusing cached regridders (LRU) across intervals and minicubes."""
+
+    arrays = [np.ascontiguousarray(a, dtype = "float64") for a in (src_x, src_y, dst_x, dst_y)]
+    key = (method, extrapolate) + tuple((len(a), hash(a.tobytes())) for a in arrays)
+
+    with REGRIDDER_CACHE_LOCK:
+        if key in REGRIDDER_CACHE:
+            REGRIDDER_CACHE.move_to_end(key)
+            return REGRIDDER_CACHE[key]
+
+    regridder = Regridder(*arrays, method = method, extrapolate = extrapolate)
+
+    with REGRIDDER_CACHE_LOCK:
+        REGRIDDER_CACHE[key] = regridder
+        while len(REGRIDDER_CACHE) > REGRIDDER_CACHE_SIZE:
+            REGRIDDER_CACHE.popitem(last = False)
+
+    return regridder
+
+
+def is_packed(da):
+    """Whether da holds packed integers, which carry scale_factor, add_offset and _FillValue in their attrs (e.g. compact Sentinel 2)."""
+    return ("_FillValue" in da.attrs) and (da.dtype.kind in "ui")
+
+
+def same_grid(a, b):
+    """Whether the coordinates a and b match up to a thousandth of their spacing."""
+    a, b = np.asarray(a, dtype = "float64"), np.asarray(b, dtype = "float64")
+    if (a.shape != b.shape) or (len(a) < 2):
+        return False
+    return bool(np.allclose(a, b, rtol = 0, atol = 1e-3 * abs(b[1] - b[0])))
+
+
+def regrid(ds, new_x, new_y, method = "linear", xdim = "x", ydim = "y"):
+    """Regrids all variables of ds that have both dimensions xdim and ydim onto the coordinates new_x, new_y. Other variables are returned unchanged.
+
+    If ds already is on the target grid (e.g. warped onto it while reading), it is returned as is. Packed integer variables (see is_packed) keep their dtype: for linear interpolation their fill values are masked before and restored after regridding.
+    """
+
+    if same_grid(ds[xdim].values, new_x) and same_grid(ds[ydim].values, new_y):
+        return ds.assign_coords({xdim: new_x, ydim: new_y})
+
+    spatial_vars = [v for v in ds.data_vars if (xdim in ds[v].dims) and (ydim in ds[v].dims)]
+
+    rest = ds.drop_vars(spatial_vars)
+    rest = rest.drop_vars([c for c in rest.coords if (xdim in rest[c].dims) or (ydim in rest[c].dims)])
+
+    if len(spatial_vars) == 0:
+        return rest.assign_coords({xdim: new_x, ydim: new_y})
+
+    regridder = get_regridder(ds[xdim].values, ds[ydim].values, new_x, new_y, method = method)
+
+    spatial = ds[spatial_vars]
+    spatial = spatial.drop_vars([c for c in spatial.coords if (xdim in spatial[c].dims) or (ydim in spatial[c].dims)])
+
+    packed = [v for v in spatial_vars if is_packed(ds[v])]
+    for v in packed:
+        if method != "nearest":
+            spatial[v] = spatial[v].where(spatial[v] != ds[v].attrs["_FillValue"]).astype("float32")
+
+    out = regridder(spatial, xdim = xdim, ydim = ydim).assign_coords({xdim: new_x, ydim: new_y})
+
+    for v in packed:
+        if out[v].dtype != ds[v].dtype:
+            out[v] = out[v].round().fillna(ds[v].attrs["_FillValue"]).astype(ds[v].dtype)
+
+    for v in spatial_vars:
+        out[v].attrs = ds[v].attrs
+
+    return xr.merge([rest, out], join = "outer", compat = "override", combine_attrs = "override")[list(ds.data_vars)]
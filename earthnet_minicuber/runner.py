@@ -0,0 +1,212 @@
+
+import os
+import json
+import time
+import random
+import datetime
+import traceback
+from pathlib import Path
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .minicuber import Minicuber
+from .provider.item_cache import set_item_cache
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+def run_job(pars):
+    """Runs Minicuber.save_minicube(**pars) in a worker process and reports the outcome as a dict."""
+
+    starttime = time.time()
+
+    try:
+        Minicuber.save_minicube(**pars)
+    except Exception as err:
+        return {
+            "status": "error",
+            "error_types": [c.__name__ for c in type(err).__mro__],
+            "error": f"{type(err).__name__}: {err}",
+            "traceback": traceback.format_exc(),
+            "duration": time.time() - starttime
+        }
+
+    return {"status": "done", "duration": time.time() - starttime}
+
+
+def kill_workers(executor):
+    """Kills the worker processes of a ProcessPoolExecutor, also if they are stuck in C code, and shuts it down."""
+    for process in list((getattr(executor, "_processes", None) or {}).values()):
+        process.kill()
+    executor.shutdown(wait = False, cancel_futures = True)
+
+
+class MinicubeRunner:
+    """Resumable multi-process runner for Minicuber.save_minicube.
+
+    Jobs are dicts of keyword arguments to Minicuber.save_minicube and are identified by their savepath. Every finished attempt is appended to a JSON lines manifest, so a restarted run skips jobs that are done (or failed permanently) and resumes the rest.
+
+    A job running longer than timeout seconds is stopped from the parent process: the worker processes are killed, the job fails with a JobTimeoutError and the other running jobs are restarted without counting an attempt.
+
+    Errors whose class name (or the name of a base class) is a key of backoff (merged into DEFAULT_BACKOFF) are retried up to max_attempts times with exponential backoff: the n-th retry waits min(base * 2 ** (n - 1), max_delay) seconds, with jitter. All other errors fail the job.
+    """
+
+    DEFAULT_BACKOFF = {
+        "APIError": (10, 600),
+        "FSTimeoutError": (10, 600),
+        "ConnectionError": (10, 600),
+        "CPLE_HttpResponseError": (30, 600),
+        "JobTimeoutError": (60, 1800),
+        "BrokenProcessPool": (10, 60),
+    }
+
+    def __init__(self, manifest_path, n_workers = 4, timeout = None, max_attempts = 5, backoff = None, skip_existing = True, retry_failed = False, item_cache = None, verbose = True):
+        self.manifest_path = Path(manifest_path)
+        self.n_workers = n_workers
+        if (timeout is not None) and (timeout <= 0):
+            raise ValueError(f"timeout must be positive, got {timeout}")
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = {**self.DEFAULT_BACKOFF, **(backoff if backoff is not None else {})}
+        self.skip_existing = skip_existing
+        self.retry_failed = retry_failed
+        self.item_cache = item_cache
+        self.verbose = verbose
+
+    def make_executor(self):
+        """Process pool whose workers enable the STAC item cache with the kwargs in item_cache (see set_item_cache), if given."""
+        if self.item_cache is None:
+            return ProcessPoolExecutor(max_workers = self.n_workers)
+        return ProcessPoolExecutor(max_workers = self.n_workers, initializer = partial(set_item_cache, **self.item_cache))
+
+    def read_manifest(self):
+        """Returns the last manifest record per savepath."""
+
+        records = {}
+        if self.manifest_path.is_file():
+            with open(self.manifest_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    records[record["savepath"]] = record
+        return records
+
+    def write_record(self, record):
+        record["time"] = datetime.datetime.now().isoformat()
+        with open(self.manifest_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def backoff_delay(self, error_types, attempt):
+        for error_type in error_types:
+            if error_type in self.backoff:
+                base, max_delay = self.backoff[error_type]
+                return min(base * 2 ** (attempt - 1), max_delay) * random.uniform(0.5, 1.0)
+        return None
+
+    def pending_jobs(self, jobs):
+        records = self.read_manifest()
+
+        pending = deque()
+        for pars in jobs:
+            savepath = str(pars["savepath"])
+            record = records.get(savepath)
+            if record is not None:
+                if record["status"] == "done":
+                    continue
+                if (record["status"] == "failed") and not self.retry_failed:
+                    continue
+            if self.skip_existing and Path(savepath).exists():
+                continue
+            attempt = record["attempt"] if (record is not None) and (record["status"] == "retry") else 0
+            pending.append((pars, attempt, 0.0))
+
+        return pending
+
+    def run(self, jobs):
+        """Runs all jobs that are not yet done and returns a dict of savepath to final status."""
+
+        self.manifest_path.parent.mkdir(exist_ok = True, parents = True)
+
+        pending = self.pending_jobs(jobs)
+        if self.verbose:
+            print(f"{len(pending)} of {len(jobs)} jobs left to run.")
+
+        statuses = {}
+        running = {}
+        executor = self.make_executor()
+        try:
+            while pending or running:
+
+                now = time.time()
+                for _ in range(len(pending)):
+                    if len(running) >= self.n_workers:
+                        break
+                    pars, attempt, not_before = pending.popleft()
+                    if not_before > now:
+                        pending.append((pars, attempt, not_before))
+                        continue
+                    running[executor.submit(run_job, pars)] = (pars, attempt + 1, time.time())
+
+                if not running:
+                    time.sleep(max(0.0, min(p[2] for p in pending) - time.time()))
+                    continue
+
+                done, _ = wait(running, timeout = 1.0, return_when = FIRST_COMPLETED)
+
+                timed_out = set()
+                if self.timeout is not None:
+                    timed_out = {future for future, (_, _, started) in running.items() if (future not in done) and (time.time() - started > self.timeout)}
+
+                broken = len(timed_out) > 0
+                for future in list(done) + list(timed_out):
+                    pars, attempt, started = running.pop(future)
+                    if future in timed_out:
+                        result = {"status": "error", "error_types": ["JobTimeoutError"], "error": f"JobTimeoutError: Job exceeded its timeout of {self.timeout} seconds.", "duration": time.time() - started}
+                    else:
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool as err:
+                            broken = True
+                            result = {"status": "error", "error_types": ["BrokenProcessPool"], "error": f"BrokenProcessPool: {err}", "duration": None}
+
+                    savepath = str(pars["savepath"])
+                    record = {"savepath": savepath, "attempt": attempt, "duration": result["duration"]}
+
+                    if result["status"] == "done":
+                        record["status"] = "done"
+                    else:
+                        record["error"] = result["error"]
+                        delay = self.backoff_delay(result["error_types"], attempt)
+                        if (delay is not None) and (attempt < self.max_attempts):
+                            record["status"] = "retry"
+                            pending.append((pars, attempt, time.time() + delay))
+                        else:
+                            record["status"] = "failed"
+
+                    self.write_record(record)
+                    statuses[savepath] = record["status"]
+
+                    if self.verbose:
+                        print(f"{savepath}: {record['status']} (attempt {attempt}){'' if 'error' not in record else ' - ' + record['error']}")
+
+                if broken:
+                    for future, (pars, attempt, _) in running.items():
+                        pending.append((pars, attempt - 1, 0.0))
+                    running = {}
+                    kill_workers(executor)
+                    executor = self.make_executor()
+        finally:
+            if running:
+                kill_workers(executor)
+            else:
+                executor.shutdown(wait = False, cancel_futures = True)
+
+        return statuses
@@ -13,6 +13,7 @@ install_requires = [
     "pillow",
     "xarray",
     "zarr",
+    "numcodecs",
     "dask",
     "netcdf4",
     "pandas",
@@ -26,7 +27,7 @@ install_requires = [
     "shapely",
     "fsspec",
     "aiohttp",
-    "odc-algo"
+    "scipy"
     ]
 
 
@@ -47,5 +48,6 @@ setup(name='earthnet-minicuber',
         install_requires=install_requires,
         extras_require={
             "EE": ["earthengine-api","wxee","eemont"],
+            "onnx": ["onnx","onnxruntime"],
         }
         )
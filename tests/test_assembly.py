@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from earthnet_minicuber.minicuber import assemble_cube
+
+
+def products(n_months = 3, n_providers = 3, size = 16, steps = 6):
+    """Synthetic regridded product cubes, one per month and provider, with provider-specific time stamps. steps must fit into a month (at most 9)."""
+    rng = np.random.default_rng(0)
+    out = []
+    for m in range(n_months):
+        for p in range(n_providers):
+            time = pd.date_range(f"2020-{m % 12 + 1:02d}-01", periods = steps, freq = "3D") + pd.Timedelta(days = 365 * (m // 12), hours = p)
+            out.append(xr.Dataset({f"p{p}_b{b}": (("time", "lat", "lon"), rng.random((steps, size, size), dtype = "float32")) for b in range(4)}, coords = {"time": time, "lat": np.arange(size), "lon": np.arange(size)}))
+    return out
+
+
+def merge_cube(products, n_providers):
+    """The repeated xr.merge accumulation assemble_cube replaces: providers are merged into a monthly cube, then all months are merged."""
+    months = []
+    for i in range(0, len(products), n_providers):
+        cube = None
+        for product in products[i:i + n_providers]:
+            cube = product if cube is None else xr.merge([cube, product], join = "outer", compat = "no_conflicts")
+        months.append(cube)
+    return xr.merge(months, join = "outer", compat = "no_conflicts", combine_attrs = "override")
+
+
+def test_assemble_cube_matches_merge():
+    pieces = products()
+    reference = merge_cube(pieces, 3)
+    cube = assemble_cube(pieces)
+    xr.testing.assert_identical(cube[list(reference.data_vars)], reference)
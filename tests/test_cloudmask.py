@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+import segmentation_models_pytorch as smp
+
+from earthnet_minicuber.provider.s2 import cloudmask
+
+
+BANDS = ["B02", "B03", "B04", "B8A"]
+
+
+def random_checkpoint(path):
+    """Saves randomly initialized weights of the rgbnir cloud mask model under path, so tests and benchmarks run without downloading the checkpoint."""
+    torch.manual_seed(0)
+    model = smp.Unet(encoder_name = "mobilenet_v2", encoder_weights = None, classes = 4, in_channels = len(BANDS))
+    torch.save(model.state_dict(), path/"mobilenetv2_l2a_rgbnir.pth")
+    return path
+
+
+def scenes(steps = 6, size = 200):
+    return 0.3 * np.random.default_rng(0).random((steps, len(BANDS), size, size), dtype = "float32")
+
+
+@pytest.fixture(scope = "module")
+def checkpoint_path(tmp_path_factory):
+    return random_checkpoint(tmp_path_factory.mktemp("checkpoint"))
+
+
+@pytest.fixture(scope = "module")
+def reference(checkpoint_path):
+    return cloudmask.CloudMask(checkpoint_path = checkpoint_path, batch_size = None, tile_size = None).predict(scenes())
+
+
+def test_batches_match_single_batch(checkpoint_path, reference):
+    mask = cloudmask.CloudMask(checkpoint_path = checkpoint_path, batch_size = 2, tile_size = None).predict(scenes())
+    np.testing.assert_array_equal(mask, reference)
+
+
+def test_tiles_match_whole_scene(checkpoint_path, reference):
+    mask = cloudmask.CloudMask(checkpoint_path = checkpoint_path, batch_size = 2, tile_size = 128, tile_overlap = 64).predict(scenes())
+    assert (mask == reference).mean() > 0.98
+
+
+@pytest.mark.parametrize("engine", ["torchscript", "onnx"])
+def test_engines_match_eager(checkpoint_path, reference, engine):
+    if engine == "onnx":
+        pytest.importorskip("onnxruntime")
+    x = torch.from_numpy(scenes()[:, :, :192, :192])
+    with torch.no_grad():
+        eager = cloudmask.load_model(BANDS, checkpoint_path = checkpoint_path)[0](x)
+        accelerated = cloudmask.load_model(BANDS, engine = engine, checkpoint_path = checkpoint_path)[0](x)
+    np.testing.assert_allclose(accelerated.numpy(), eager.numpy(), atol = 1e-5)
+
+    mask = cloudmask.CloudMask(checkpoint_path = checkpoint_path, batch_size = None, tile_size = None, engine = engine).predict(scenes())
+    assert (mask == reference).mean() > 0.999
+
+
+def test_quantized_onnx_agrees(checkpoint_path, reference):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    mask = cloudmask.CloudMask(checkpoint_path = checkpoint_path, batch_size = None, tile_size = None, engine = "onnx", quantize = True).predict(scenes())
+    assert (mask == reference).mean() > 0.9
+
+
+def test_model_loaded_once(checkpoint_path):
+    first = cloudmask.CloudMask(checkpoint_path = checkpoint_path)
+    second = cloudmask.CloudMask(checkpoint_path = checkpoint_path)
+    assert first.model is second.model
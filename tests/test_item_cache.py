@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pystac
+import pystac_client
+import pytest
+
+from earthnet_minicuber.provider import item_cache, stac_utils
+from earthnet_minicuber.provider.item_cache import ItemCache
+
+
+def make_items(n = 3, collection = "test"):
+    items = []
+    for i in range(n):
+        item = pystac.Item(f"item{i}", {"type": "Point", "coordinates": [10.0 + i, 50.0]}, [10.0 + i, 50.0, 10.0 + i, 50.0], pystac.utils.str_to_datetime(f"2020-01-0{i + 1}T00:00:00Z"), {}, collection = collection)
+        item.add_asset("B02", pystac.Asset(f"https://example.com/{collection}/item{i}/B02.tif"))
+        items.append(item)
+    return pystac.ItemCollection(items)
+
+
+class StacHandler(BaseHTTPRequestHandler):
+    """Minimal STAC API: a landing page and an item search that counts its requests."""
+
+    def respond(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        root = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+        if self.path.startswith("/search"):
+            return self.search()
+        self.respond({
+            "type": "Catalog", "id": "stand-in", "description": "Stand-in STAC API", "stac_version": "1.0.0",
+            "conformsTo": ["https://api.stacspec.org/v1.0.0/core", "https://api.stacspec.org/v1.0.0/item-search"],
+            "links": [
+                {"rel": "self", "href": f"{root}/", "type": "application/json"},
+                {"rel": "root", "href": f"{root}/", "type": "application/json"},
+                {"rel": "search", "href": f"{root}/search", "type": "application/geo+json", "method": "GET"},
+                {"rel": "search", "href": f"{root}/search", "type": "application/geo+json", "method": "POST"},
+            ],
+        })
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.search()
+
+    def search(self):
+        self.server.searches += 1
+        self.respond({**make_items().to_dict(), "links": []})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def catalog():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StacHandler)
+    server.searches = 0
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield pystac_client.Client.open(f"http://127.0.0.1:{server.server_address[1]}/"), server
+    server.shutdown()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    yield item_cache.set_item_cache(tmp_path / "cache", ttl = 3600, max_size = 2 ** 20)
+    item_cache.set_item_cache(None)
+
+
+def test_ttl_expiry(tmp_path):
+    cache = ItemCache(tmp_path, ttl = 60)
+    cache.put("a", make_items())
+    assert len(cache.get("a")) == 3
+
+    path = tmp_path / "a.json"
+    entry = json.loads(path.read_text())
+    entry["created"] -= 120
+    path.write_text(json.dumps(entry))
+
+    assert cache.get("a") is None
+    assert not path.exists()
+
+
+def test_lru_eviction(tmp_path):
+    cache = ItemCache(tmp_path, max_size = None)
+    for key in ["a", "b", "c"]:
+        cache.put(key, make_items())
+    size = (tmp_path / "a.json").stat().st_size
+
+    now = time.time()
+    for age, key in [(30, "a"), (20, "b"), (10, "c")]:
+        os.utime(tmp_path / f"{key}.json", (now - age, now - age))
+    cache.get("a")
+
+    cache.max_size = int(2.5 * size)
+    cache.evict()
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_search_items_cache_hit_and_miss(catalog, cache):
+    client, server = catalog
+    bbox = [9.5, 49.5, 13.5, 50.5]
+
+    items = stac_utils.search_items(client, bbox, ["test"], datetime = "2020-01-01/2020-01-31")
+    assert [item.id for item in items] == ["item0", "item1", "item2"]
+    assert server.searches == 1
+
+    cached = stac_utils.search_items(client, bbox, ["test"], datetime = "2020-01-01/2020-01-31")
+    assert [item.id for item in cached] == ["item0", "item1", "item2"]
+    assert server.searches == 1
+
+    stac_utils.search_items(client, bbox, ["test"], datetime = "2020-02-01/2020-02-29")
+    assert server.searches == 2
+
+
+def test_resign_on_hit(catalog, cache, monkeypatch):
+    client, server = catalog
+    tokens = iter(["token1", "token2"])
+
+    def sign(items):
+        token = next(tokens)
+        items = items.clone()
+        for item in items:
+            for asset in item.assets.values():
+                asset.href = f"{asset.href}?{token}"
+        return items
+
+    monkeypatch.setattr(stac_utils.pc, "sign", sign)
+
+    first = stac_utils.search_items(client, [9.5, 49.5, 13.5, 50.5], ["test"], sign = True)
+    second = stac_utils.search_items(client, [9.5, 49.5, 13.5, 50.5], ["test"], sign = True)
+
+    assert server.searches == 1
+    assert first[0].assets["B02"].href.endswith("?token1")
+    assert second[0].assets["B02"].href.endswith("?token2")
+    assert "token" not in list(cache.cachedir.glob("*.json"))[0].read_text()
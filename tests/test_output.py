@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from earthnet_minicuber.minicuber import Minicuber
+from earthnet_minicuber.provider.provider_base import Provider
+
+
+def minicube(steps = 30, size = 64, bands = 6):
+    """A synthetic minicube: smooth reflectances with clouds of NaN, a categorical mask and a static variable."""
+    rng = np.random.default_rng(0)
+    y, x = np.meshgrid(np.linspace(0, 1, size), np.linspace(0, 1, size), indexing = "ij")
+    time = pd.date_range("2020-01-01", periods = steps, freq = "5D")
+    data_vars = {}
+    for b in range(bands):
+        v = (0.1 + 0.3 * np.sin(3 * x + b) * np.cos(2 * y) ** 2)[None] + rng.normal(0, 0.01, (steps, size, size))
+        v[rng.random((steps, size, size)) < 0.2] = np.nan
+        data_vars[f"s2_B{b}"] = (("time", "lat", "lon"), v.astype("float32"), {"interpolation_type": "linear"})
+    data_vars["s2_mask"] = (("time", "lat", "lon"), rng.integers(0, 5, (steps, size, size)).astype("float32"), {"interpolation_type": "nearest"})
+    data_vars["dem"] = (("lat", "lon"), (1000 * y + 200 * x).astype("float32"), {"interpolation_type": "linear"})
+    return xr.Dataset(data_vars, coords = {"time": time, "lat": np.linspace(50, 49.9, size), "lon": np.linspace(10, 10.1, size)})
+
+
+def test_zarr_matches_netcdf(tmp_path):
+    cube = minicube()
+    Minicuber.save_minicube_netcdf(cube, tmp_path/"cube.nc")
+    Minicuber.save_minicube_zarr(cube, tmp_path/"cube.zarr", n_threads = 2)
+
+    with xr.open_dataset(tmp_path/"cube.nc") as nc, xr.open_zarr(tmp_path/"cube.zarr") as zarr:
+        for v in cube.data_vars:
+            np.testing.assert_array_equal(zarr[v].values, nc[v].values)
+            assert zarr[v].encoding["dtype"] == nc[v].encoding["dtype"]
+        np.testing.assert_allclose(zarr.s2_B0.values, cube.s2_B0.values, atol = 1e-4)
+
+
+class MonthlyProvider(Provider):
+    """Random float data whose range grows month by month, or packed uint16 data, on a 40 x 40 lon/lat grid."""
+
+    def __init__(self, name, packed = False):
+        self.name = name
+        self.packed = packed
+        self.is_temporal = True
+
+    def load_data(self, bbox, time_interval, **kwargs):
+        rng = np.random.default_rng(int(time_interval[5:7]))
+        time = pd.date_range(time_interval[:10], time_interval[-10:], freq = "5D")
+        coords = {"time": time, "lat": np.linspace(bbox[3], bbox[1], 40), "lon": np.linspace(bbox[0], bbox[2], 40)}
+        if self.packed:
+            return xr.Dataset({self.name: (("time", "lat", "lon"), rng.integers(1, 5000, (len(time), 40, 40)).astype("uint16"), {"interpolation_type": "linear", "scale_factor": 1e-4, "add_offset": 0.0, "_FillValue": 0})}, coords = coords)
+        return xr.Dataset({self.name: (("time", "lat", "lon"), (int(time_interval[5:7]) * rng.random((len(time), 40, 40))).astype("float32"), {"interpolation_type": "linear"})}, coords = coords)
+
+
+def test_stream_matches_save_minicube_zarr(tmp_path):
+    specs = {"lon_lat": (11.0, 51.0), "xy_shape": (32, 32), "resolution": 20, "time_interval": "2019-01-01/2019-04-30"}
+    providers = lambda: [MonthlyProvider("s2"), MonthlyProvider("compact", packed = True)]
+
+    Minicuber(specs, providers = providers()).stream(tmp_path/"stream.zarr", verbose = False, compressor = "lz4", chunks = {"time": 4})
+    cube = Minicuber(specs, providers = providers()).load(compute = True, verbose = False)
+    Minicuber.save_minicube_zarr(cube, tmp_path/"cube.zarr", compressor = "lz4", chunks = {"time": 4})
+
+    assert not (tmp_path/"stream.zarr.stream").exists()
+    with xr.open_zarr(tmp_path/"stream.zarr", mask_and_scale = False) as stream, xr.open_zarr(tmp_path/"cube.zarr", mask_and_scale = False) as expected:
+        for v in expected.data_vars:
+            assert stream[v].attrs == expected[v].attrs
+            assert stream[v].encoding["chunks"] == expected[v].encoding["chunks"]
+            np.testing.assert_array_equal(stream[v].values, expected[v].values)
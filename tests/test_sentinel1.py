@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy.ndimage import uniform_filter, variance
+
+from earthnet_minicuber.provider.sentinel1 import lee_filter, QueganFilter
+
+
+def lee_filter_slice(da, size):
+    """The Lee filter of a single 2D slice before vectorization, in float64."""
+    img = da.values
+    img_mean = uniform_filter(img, (size, size))
+    img_sqr_mean = uniform_filter(img**2, (size, size))
+    img_variance = img_sqr_mean - img_mean**2
+
+    overall_variance = variance(img)
+
+    img_weights = img_variance / (img_variance + overall_variance)
+    img_output = img_mean + img_weights * (img - img_mean)
+
+    return img_output
+
+
+def lee_filter_per_slice(stack, size):
+    """Filters each polarization and date separately, as Sentinel1.load_data did before vectorization."""
+    return xr.Dataset({v: stack[v].copy(data = np.stack([lee_filter_slice(stack[v].isel(time = t), size) for t in range(len(stack.time))])) for v in stack.data_vars})
+
+
+def backscatter(steps = 8, size = 96, looks = 4):
+    """A synthetic (time, y, x) stack of vv and vh backscatter: a smooth field with gamma distributed speckle of the given number of looks."""
+    rng = np.random.default_rng(0)
+    y, x = np.meshgrid(np.linspace(0, 1, size), np.linspace(0, 1, size), indexing = "ij")
+    field = 0.05 + 0.2 * (x > 0.5) + 0.1 * np.sin(6 * y)
+    coords = {"time": pd.date_range("2020-01-01", periods = steps, freq = "6D"), "y": np.arange(size), "x": np.arange(size)}
+    return xr.Dataset({v: (("time", "y", "x"), (scale * field * rng.gamma(looks, 1 / looks, (steps, size, size))).astype("float32")) for v, scale in [("s1_vv", 1.0), ("s1_vh", 0.2)]}, coords = coords)
+
+
+def test_lee_matches_per_slice_filter():
+    stack = backscatter()
+    reference = lee_filter_per_slice(stack.astype("float64"), 9)
+    filtered = lee_filter(stack.to_array("band"), 9).to_dataset("band")
+    for v in stack.data_vars:
+        assert filtered[v].dtype == "float32"
+        np.testing.assert_allclose(filtered[v].values, reference[v].values, rtol = 1e-4, atol = 1e-6 * float(stack[v].mean()))
+
+
+@pytest.mark.parametrize("chunks", [{"time": 1}, {"time": 3, "y": 40, "x": 50}])
+def test_lee_dask_matches_numpy(chunks):
+    stack = backscatter().to_array("band")
+    stack[0, 2, 10:20, 30:50] = np.nan
+    expected = lee_filter(stack, 9)
+    filtered = lee_filter(stack.chunk(chunks), 9)
+    assert filtered.chunks is not None
+    np.testing.assert_allclose(filtered.values, expected.values, rtol = 1e-5)
+    assert np.isnan(filtered.values[0, 2, 10:20, 30:50]).all()
+
+
+def enl(img):
+    """Equivalent number of looks of a homogeneous area."""
+    img = img[np.isfinite(img)]
+    return img.mean() ** 2 / img.var()
+
+
+def speckle(steps, size = 128):
+    """Single look speckle of a constant vv backscatter, as a (pol, time, y, x) array."""
+    data = 0.1 * np.random.default_rng(1).gamma(1, 1, (1, steps, size, size)).astype("float32")
+    return xr.DataArray(data, coords = {"pol": ["s1_vv"], "time": pd.date_range("2020-01-01", periods = steps, freq = "6D"), "y": np.arange(size), "x": np.arange(size)}, dims = ("pol", "time", "y", "x"))
+
+
+def test_quegan_filters_first_date():
+    da = speckle(1)
+    filtered = QueganFilter(size = 9)(da)
+    assert not np.allclose(filtered.values, da.values)
+    assert enl(filtered.values) > 3 * enl(da.values)
+
+
+def test_quegan_streams_across_calls():
+    da = speckle(12)
+    quegan = QueganFilter(size = 9)
+    filtered = xr.concat([quegan(da.isel(time = slice(i, i + 3))) for i in range(0, 12, 3)], dim = "time")
+    np.testing.assert_allclose(filtered.values, QueganFilter(size = 9)(da).values, rtol = 1e-5)
+    looks = [enl(filtered.values[:, t]) for t in range(12)]
+    assert looks[-1] > looks[4] > enl(da.values)
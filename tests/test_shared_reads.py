@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+from earthnet_minicuber.minicuber import Minicuber
+from earthnet_minicuber.provider.provider_base import Provider
+
+
+class SelectingProvider(Provider):
+    """Selects items per bbox from a table of (candidates, selected) ids, like the Sentinel 2 best orbit filter."""
+
+    def __init__(self, selections):
+        self.selections = selections
+
+    def item_selection(self, bbox, time_interval, **kwargs):
+        return self.selections[bbox]
+
+    def load_data(self, bbox, time_interval, **kwargs):
+        return None
+
+
+def minicubers(n):
+    return [SimpleNamespace(padded_bbox = i, full_time_interval = "2020-01-01/2020-12-31") for i in range(n)]
+
+
+def test_read_groups_without_selection():
+    provider = SelectingProvider({i: None for i in range(3)})
+    assert Minicuber.read_groups(minicubers(3), provider, "2020-01-01/2020-01-31") == [([0, 1, 2], None)]
+
+
+def test_read_groups_split_on_disagreeing_selection():
+    provider = SelectingProvider({
+        # Cubes 0 and 1 overlap items a and b and both select the orbit of a.
+        0: (frozenset("ab"), frozenset("a")),
+        1: (frozenset("abc"), frozenset("ac")),
+        # Cube 2 also intersects a, but selects the orbit of b.
+        2: (frozenset("ab"), frozenset("b")),
+        # Cube 3 only intersects d, which nobody else intersects.
+        3: (frozenset("d"), frozenset("d")),
+    })
+    groups = Minicuber.read_groups(minicubers(4), provider, "2020-01-01/2020-01-31")
+    assert groups == [([0, 1, 3], {"a", "c", "d"}), ([2], {"b"})]
+
+
+def test_load_minicubes_rejects_kwargs_with_shared_reads():
+    with pytest.raises(TypeError):
+        next(Minicuber.load_minicubes([], n_workers = 4))
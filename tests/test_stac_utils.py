@@ -0,0 +1,63 @@
+import datetime
+import os
+
+import numpy as np
+import pystac
+import pyproj
+import pytest
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from earthnet_minicuber.provider import stac_utils
+
+
+N = 2048
+TRANSFORM = from_origin(500000, 5000000, 10, 10)
+
+
+def bytes_read():
+    with open("/proc/self/io") as f:
+        return int([l for l in f if l.startswith("rchar")][0].split()[1])
+
+
+@pytest.fixture(scope = "module")
+def items(tmp_path_factory):
+    path = tmp_path_factory.mktemp("cog")
+    tmp, cog = str(path / "tmp.tif"), str(path / "cog.tif")
+    data = np.random.default_rng(0).integers(0, 10000, (N, N), dtype = "uint16")
+    profile = dict(driver = "GTiff", width = N, height = N, count = 1, dtype = "uint16", crs = "EPSG:32632", transform = TRANSFORM, tiled = True, blockxsize = 512, blockysize = 512, compress = "deflate")
+    with rasterio.open(tmp, "w", **profile) as f:
+        f.write(data, 1)
+        f.build_overviews([2, 4, 8, 16], Resampling.average)
+    rasterio.shutil.copy(tmp, cog, driver = "COG", compress = "deflate")
+
+    bbox = pyproj.Transformer.from_crs(32632, 4326, always_xy = True).transform_bounds(500000, 5000000 - N * 10, 500000 + N * 10, 5000000)
+    item = pystac.Item("cog", {"type": "Polygon", "coordinates": [[[bbox[0], bbox[1]], [bbox[2], bbox[1]], [bbox[2], bbox[3]], [bbox[0], bbox[3]], [bbox[0], bbox[1]]]]}, list(bbox), datetime.datetime(2020, 1, 1), {"proj:epsg": 32632})
+    item.add_asset("B02", pystac.Asset(cog, media_type = pystac.MediaType.COG, extra_fields = {"proj:transform": list(TRANSFORM)[:6], "proj:shape": [N, N]}))
+    return [item]
+
+
+def load(items, resolution):
+    bbox = pyproj.Transformer.from_crs(32632, 4326, always_xy = True).transform_bounds(500000 + 1000, 5000000 - N * 10 + 1000, 500000 + N * 10 - 1000, 5000000 - 1000)
+    before = bytes_read()
+    data = stac_utils.stack(items, 32632, bbox, assets = ["B02"], resolution = resolution, dtype = "float64", rescale = False, xy_coords = "center", chunksize = 1024).compute(scheduler = "sync")
+    return data, bytes_read() - before
+
+
+def test_overview_level():
+    assert stac_utils.overview_level(1.5) is None
+    assert stac_utils.overview_level(2) == 0
+    assert stac_utils.overview_level(6) == 1
+    assert stac_utils.overview_level(100) == 5
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/io"), reason = "needs /proc/self/io to count bytes read")
+def test_overview_reads_fewer_bytes(items):
+    coarse, coarse_bytes = load(items, 60)
+    native, native_bytes = load(items, 10)
+
+    assert native.sizes["x"] > 5 * coarse.sizes["x"]
+    assert coarse_bytes < native_bytes / 8
+    assert abs(float(coarse.mean()) - float(native.mean())) < 0.01 * float(native.mean())